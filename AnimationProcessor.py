@@ -0,0 +1,139 @@
+import argparse
+import logging
+import os
+import re
+import time
+
+from PIL import Image, ImageSequence
+
+import TextProcessor
+import text_painter.ImageScaler as ImageScaler
+from text_painter.AnimationPainter import AnimationPainter
+from utils.Pixels import get_pixel_array, should_paint_pixels
+
+IMAGE_EXTENSIONS = ('.bmp', '.gif', '.jpeg', '.jpg', '.png', '.tif', '.tiff', '.webp')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Converts an animation to an animation of text')
+    parser.add_argument(
+        '-i', '--image', help='An animated GIF/APNG/WebP or a directory of numbered frames', required=True)
+    parser.add_argument(
+        '-t', '--text', help='The text file to be used', required=True)
+    parser.add_argument(
+        '-o', '--output', help='Filename to save the animation to, the extension picks the format (.gif, .png, .webp)',
+        required=True)
+    parser.add_argument('-f', '--font', nargs=3, default=[os.path.join('.', 'fonts', 'JetBrainsMono', '2.304', 'fonts', 'ttf', 'JetBrainsMono-Regular.ttf'), 8, 14],
+                        help='Font to be used.  Must include Filename of a TrueType (.ttf) font, font width in pixels when rendered at 15px, and height when rendered at 15px. (default: (JetBrainsMono-Regular.ttf, 8, 14))')
+    parser.add_argument('-m', '--margin', type=int, nargs=2, default=[
+                        0, 0], help='The number of pixels to add as a margin around the final image. Must include both a width and a height (default: 0 0)')
+    parser.add_argument('-c', '--char_threshold', type=float, default=250.0,
+                        help='A brightness threshold between 0 (black) and 255 (white).  Pixels below this threshold wont be replaced by a character and will be left blank.  (default: 250)')
+    parser.add_argument('-b', '--background_color', type=int, nargs=3, default=[
+                        255, 255, 255], help='The RGB values of the color to use for the background of the image (default: 255 255 255)')
+    parser.add_argument('-p', '--processor', default='DuotoneProcessor',
+                        help='pre-process every frame using the given processor')
+    parser.add_argument('-a', '--processor_arguments', nargs='*',
+                        help='a list of arguments to be passed to the processor')
+    parser.add_argument('-d', '--duration', type=int, default=100,
+                        help='The duration in milliseconds of frames that do not define one, like numbered frame files. (default: 100)')
+    parser.add_argument('--loop', type=int, default=0,
+                        help='The number of times the animation loops, 0 loops forever. (default: 0)')
+    parser.add_argument('--logging', help='Logging level possible values: [DEBUG, INFO, WARNING, ERROR, '
+                        'CRITICAL] (default: INFO)')
+    args = TextProcessor.normalize_args(parser.parse_args())
+
+    logging.info(
+        "getting frames from [%s] and text from [%s]", args.image, args.text)
+    text = TextProcessor.get_text_source(args.text)
+    font = TextProcessor.get_font(args.font)
+
+    images, durations = process_animation(lambda: iter_frames(args.image, args.duration), text, font,
+                                          (args.margin[0], args.margin[1]), float(args.char_threshold),
+                                          args.background_color, args.processor, args.processor_arguments)
+
+    logging.info("saving [%s] frames to [%s]", len(images), args.output)
+    images[0].save(args.output, save_all=True, append_images=images[1:], duration=durations, loop=args.loop)
+    logging.info("processing complete")
+
+
+def process_animation(frames, text, font, margin, char_threshold, background_color, processor_name, processor_arguments):
+    """
+    Converts every frame of an animation to a text image.  The text grid size is chosen once from the first frame and
+    the processor is initialized once from the first frame so the layout and colors are stable across frames.  Only
+    the cells that change between frames are repainted.
+
+    Args:
+        frames: A function returning a new iterator of (RGBA image, duration in milliseconds) tuples.  The frames are
+            read twice, once to lay out the text and once to paint them.
+        text: The text, a string or a utils.TextSource.
+        font: A tuple containing (An ImageFont (should be monospaced), font pixel width, font pixel height).
+        margin: A tuple (margin width, margin height) containing the pixel margin to add a border of the image.
+        char_threshold: A brightness threshold between 0 (black) and 255 (white).
+        background_color: A tuple containing the RGB values to be used for the background color of the image.
+        processor_name: The processor used to process every frame.
+        processor_arguments: A list of arguments to be passed to the processor.
+
+    Returns:
+        A tuple (list of text images, list of frame durations).
+    """
+    first_frame, _ = next(iter(frames()))
+    processor = TextProcessor.get_processor(processor_name, first_frame, processor_arguments)
+    vectorized = processor.supports_arrays()
+    grid_size = ImageScaler.scale_image_to_text(text, first_frame, (font[1], font[2]), processor.should_paint_pixel,
+                                                processor.should_paint_array if vectorized else None).size
+    logging.info('using text grid width: [%s] height: [%s] for every frame', grid_size[0], grid_size[1])
+
+    def grid_frames():
+        for frame, duration in frames():
+            image = ImageScaler.scale_for_font_ratio(frame, (font[1], font[2])).resize(grid_size)
+            yield process_frame(processor, image), duration
+
+    layout_mask = None
+    for pixels, _ in grid_frames():
+        mask = should_paint_pixels(pixels, char_threshold)
+        layout_mask = mask if layout_mask is None else layout_mask | mask
+
+    painter = AnimationPainter(text, layout_mask, font, margin, char_threshold, background_color)
+    images, durations = [], []
+    for pixels, duration in grid_frames():
+        start = time.perf_counter()
+        canvas, repainted = painter.paint(pixels)
+        images.append(Image.fromarray(canvas))
+        durations.append(duration)
+        logging.info('painted frame [%s] - repainted cells: [%s] of [%s] in [%.3f]s', len(images), repainted,
+                     grid_size[0] * grid_size[1], time.perf_counter() - start)
+
+    return images, durations
+
+
+def process_frame(processor, image):
+    """Runs the processor on a single scaled frame and returns the processed HxWx4 pixel array."""
+    if processor.supports_arrays():
+        return processor.process_array(get_pixel_array(image))[0]
+    processor.image = image
+    processor.process()
+    return get_pixel_array(processor.image)
+
+
+def iter_frames(path, default_duration):
+    """
+    Yields the (RGBA image, duration in milliseconds) of every frame of an animated image or of every image in a
+    directory, sorted by the numbers in their file names.
+    """
+    if os.path.isdir(path):
+        names = sorted((name for name in os.listdir(path) if name.lower().endswith(IMAGE_EXTENSIONS)),
+                       key=lambda name: [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)])
+        for name in names:
+            with Image.open(os.path.join(path, name)) as image:
+                yield image.convert('RGBA'), default_duration
+        return
+
+    with Image.open(path) as image:
+        for frame in ImageSequence.Iterator(image):
+            yield frame.convert('RGBA'), frame.info.get('duration') or default_duration
+
+
+if __name__ == '__main__':
+    main()
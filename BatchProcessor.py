@@ -0,0 +1,298 @@
+import argparse
+import csv
+import json
+import logging
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from PIL import Image
+
+import TextProcessor
+import text_painter.GlyphCache as GlyphCache
+import text_painter.ImageScaler as ImageScaler
+import text_painter.ScaleCache as ScaleCache
+import utils.ImageEncoder as ImageEncoder
+from utils.Pipeline import DEFAULT_QUEUE_SIZE, Pipeline
+
+IMAGE_EXTENSIONS = ('.bmp', '.gif', '.jpeg', '.jpg', '.png', '.tif', '.tiff', '.webp')
+# the items are split into this many pipelined chunks per worker, more chunks balance uneven images better
+CHUNKS_PER_WORKER = 2
+
+_text = None
+_font = None
+_options = None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Converts many images to images of text, loading the text, font and processor only once')
+    parser.add_argument(
+        '-i', '--input', help='A directory of images or a .csv/.json manifest listing the images to convert', required=True)
+    parser.add_argument(
+        '-t', '--text', help='The text file to be used', required=True)
+    parser.add_argument(
+        '-o', '--output_dir', help='The directory to save the processed images to.  Relative manifest outputs are '
+        'resolved against it', required=True)
+    parser.add_argument('-f', '--font', nargs=3, default=[os.path.join('.', 'fonts', 'JetBrainsMono', '2.304', 'fonts', 'ttf', 'JetBrainsMono-Regular.ttf'), 8, 14],
+                        help='Font to be used.  Must include Filename of a TrueType (.ttf) font, font width in pixels when rendered at 15px, and height when rendered at 15px. (default: (JetBrainsMono-Regular.ttf, 8, 14))')
+    parser.add_argument('-m', '--margin', type=int, nargs=2, default=[
+                        0, 0], help='The number of pixels to add as a margin around the final image. Must include both a width and a height (default: 0 0)')
+    parser.add_argument('-c', '--char_threshold', type=float, default=250.0,
+                        help='The default brightness threshold between 0 (black) and 255 (white).  Can be overridden per image. (default: 250)')
+    parser.add_argument('-b', '--background_color', type=int, nargs=3, default=[
+                        255, 255, 255], help='The RGB values of the color to use for the background of the image (default: 255 255 255)')
+    parser.add_argument('-p', '--processor', default='DuotoneProcessor',
+                        help='pre-process the images using the given processor')
+    parser.add_argument('-a', '--processor_arguments', nargs='*',
+                        help='the default list of arguments to be passed to the processor.  Can be overridden per image.')
+    parser.add_argument('-r', '--renderer', choices=['atlas', 'reference'], default='atlas',
+                        help='How characters are painted, see TextProcessor.py. (default: atlas)')
+    parser.add_argument('--scaler_resample', choices=ImageScaler.RESAMPLE_MODES, default='pyramid',
+                        help='How the scaler resizes candidate sizes, see TextProcessor.py. (default: pyramid)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                        help='The number of images converted at the same time. (default: the number of CPUs)')
+    parser.add_argument('--cache', action=argparse.BooleanOptionalAction, default=True,
+                        help='Cache scaling results on disk, see TextProcessor.py. (default: --cache)')
+    parser.add_argument('--cache_dir', '--cache-dir', default=ScaleCache.DEFAULT_CACHE_DIR,
+                        help='The directory scaling results are cached in. (default: %s)' % ScaleCache.DEFAULT_CACHE_DIR)
+    parser.add_argument('--cache_size', type=int, default=ScaleCache.DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help='The size in MB above which the least recently used cached results are removed. (default: 512)')
+    parser.add_argument('--glyph_cache', action=argparse.BooleanOptionalAction, default=True,
+                        help='Keep rasterized glyphs in an atlas on disk, see TextProcessor.py. (default: --glyph_cache)')
+    parser.add_argument('--glyph_cache_dir', '--glyph-cache-dir', default=GlyphCache.DEFAULT_CACHE_DIR,
+                        help='The directory glyph atlases are stored in. (default: %s)' % GlyphCache.DEFAULT_CACHE_DIR)
+    parser.add_argument('--glyph_cache_size', type=int, default=GlyphCache.DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help='The size in MB of the glyphs kept in memory by every worker. (default: 64)')
+    parser.add_argument('--pipeline', action=argparse.BooleanOptionalAction, default=True,
+                        help='Decode the next image and encode the previous one on separate threads while the current '
+                        'one is converted. (default: --pipeline)')
+    parser.add_argument('--queue_size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help='The most images waiting between two pipeline stages of a worker. (default: %s)' %
+                        DEFAULT_QUEUE_SIZE)
+    parser.add_argument('--output_format', choices=ImageEncoder.ENCODERS, default='png',
+                        help='The format of outputs that aren\'t named by the manifest, raw writes the RGBA pixels '
+                        'without a header or compression. (default: png)')
+    parser.add_argument('--compress_level', type=int, choices=range(10), default=ImageEncoder.DEFAULT_COMPRESS_LEVEL,
+                        metavar='{0-9}', help='The PNG compression level, 0 is fastest and 9 smallest. (default: %s)' %
+                        ImageEncoder.DEFAULT_COMPRESS_LEVEL)
+    parser.add_argument('--quality', type=int, help='The WebP and JPEG quality between 0 and 100, WebP is lossless at '
+                        '100. (default: the encoder\'s default)')
+    parser.add_argument('--report', help='A file to write a JSON report with the timing and result of every image to')
+    parser.add_argument('--logging', help='Logging level possible values: [DEBUG, INFO, WARNING, ERROR, '
+                        'CRITICAL] (default: INFO)')
+    args = TextProcessor.normalize_args(parser.parse_args())
+
+    if args.queue_size < 1:
+        parser.error('--queue_size must be at least 1')
+    if args.quality is not None and not 0 <= args.quality <= 100:
+        parser.error('--quality must be between 0 and 100')
+
+    items = get_items(args.input, args.output_dir, args.char_threshold, args.processor_arguments,
+                      ImageEncoder.get_extension(args.output_format))
+    logging.info('converting [%s] images from [%s] with [%s] workers', len(items), args.input, args.workers)
+    options = {
+        'margin': tuple(args.margin),
+        'background_color': args.background_color,
+        'processor': args.processor,
+        'renderer': args.renderer,
+        'scaler_resample': args.scaler_resample,
+        'cache': TextProcessor.get_scale_cache(args),
+        'glyph_cache': TextProcessor.get_glyph_cache(args),
+        'pipeline': args.pipeline,
+        'queue_size': args.queue_size,
+        'compress_level': args.compress_level,
+        'quality': args.quality,
+    }
+
+    start = time.perf_counter()
+    results = process_items(items, args.text, args.font, options, args.workers)
+    elapsed = time.perf_counter() - start
+
+    failed = [result for result in results if result['status'] != 'ok']
+    logging.info('converted [%s] of [%s] images in [%.2f]s', len(results) - len(failed), len(results), elapsed)
+    for result in failed:
+        logging.error('failed [%s]: %s', result['image'], result['error'])
+
+    if args.report:
+        with open(args.report, mode='wt', encoding='UTF-8') as file:
+            json.dump({'seconds': elapsed, 'items': results}, file, indent=2)
+        logging.info('writing report to [%s]', os.path.abspath(args.report))
+
+    if failed:
+        sys.exit(1)
+
+
+def get_items(source, output_dir, char_threshold, processor_arguments, output_extension='.png'):
+    """
+    Returns the list of images to convert.  Every item is a dict with the image path, the output path, the
+    char_threshold and the processor_arguments to use for that image.
+
+    Args:
+        source: A directory of images, a .json manifest containing a list of objects or a .csv manifest with a header
+            row.  Manifest entries must have an `image` field and can override `output`, `char_threshold` and
+            `processor_arguments` (a list in JSON, space separated in CSV).  Relative images are resolved against
+            the manifest directory.
+        output_dir: The directory outputs are saved to.  Relative manifest outputs are resolved against it.
+        char_threshold: The default char_threshold.
+        processor_arguments: The default processor_arguments.
+        output_extension: The extension of outputs that aren't named by the manifest. default: .png
+    """
+    if os.path.isdir(source):
+        entries = [{'image': os.path.join(source, name)} for name in sorted(os.listdir(source))
+                   if name.lower().endswith(IMAGE_EXTENSIONS)]
+        base_dir = ''
+    elif source.lower().endswith('.json'):
+        with open(source, encoding='UTF-8') as file:
+            entries = json.load(file)
+        entries = entries['items'] if isinstance(entries, dict) else entries
+        base_dir = os.path.dirname(source)
+    else:
+        with open(source, encoding='UTF-8', newline='') as file:
+            entries = list(csv.DictReader(file))
+        base_dir = os.path.dirname(source)
+
+    items = []
+    for entry in entries:
+        image = os.path.join(base_dir, entry['image'])
+        output = entry.get('output') or os.path.splitext(os.path.basename(image))[0] + output_extension
+        arguments = entry.get('processor_arguments') or processor_arguments
+        if isinstance(arguments, str):
+            arguments = arguments.split()
+        # an explicit threshold of 0 is kept, only missing values and empty CSV cells use the default
+        threshold = entry.get('char_threshold')
+        items.append({
+            'image': image,
+            'output': os.path.join(output_dir, output),
+            'char_threshold': float(char_threshold if threshold in (None, '') else threshold),
+            'processor_arguments': None if arguments is None else [str(argument) for argument in arguments],
+        })
+    return items
+
+
+def process_items(items, text_filename, font, options, workers):
+    """
+    Converts every item, returning a result for each item in the same order.  A failed item doesn't stop the batch.
+    With options['pipeline'] every worker converts a chunk of items at a time, decoding and encoding on separate
+    threads while it converts.  An item whose output was already claimed by an earlier item, like a.png and a.jpg
+    in the same directory, fails without being converted instead of overwriting it.
+    """
+    results = [None] * len(items)
+    outputs = {}
+    convert = []
+    for i, item in enumerate(items):
+        output = os.path.normcase(os.path.abspath(item['output']))
+        if output in outputs:
+            results[i] = {'image': item['image'], 'output': item['output'], 'status': 'failed',
+                          'error': 'the output is also written by [%s]' % outputs[output], 'seconds': 0.0}
+        else:
+            outputs[output] = item['image']
+            convert.append(i)
+
+    for i, result in zip(convert, _convert_items([items[i] for i in convert], text_filename, font, options, workers)):
+        results[i] = result
+    return results
+
+
+def _convert_items(items, text_filename, font, options, workers):
+    # the text is indexed once here, workers reopen the memory-mapped file with the cached index
+    text = TextProcessor.get_text_source(text_filename)
+    if workers <= 1:
+        _init_worker(text, font, options)
+        return process_chunk(items)
+
+    chunk_size = math.ceil(len(items) / (workers * CHUNKS_PER_WORKER)) if options['pipeline'] else 1
+    chunks = [items[start:start + chunk_size] for start in range(0, len(items), max(chunk_size, 1))]
+    results = [None] * len(chunks)
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(text, font, options)) as executor:
+        futures = {executor.submit(process_chunk, chunk): i for i, chunk in enumerate(chunks)}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return [result for chunk_results in results for result in chunk_results]
+
+
+def process_chunk(items):
+    """Converts a list of items, in a pipeline when it is enabled, and returns their results in order."""
+    if not _options['pipeline'] or len(items) < 2:
+        return [process_item(item) for item in items]
+
+    pipeline = Pipeline([('decode', decode_item), ('convert', convert_item), ('encode', encode_item)],
+                        _options['queue_size'])
+    return list(pipeline.run(items))
+
+
+def process_item(item):
+    """Converts a single item and returns a result dict with its status and timing."""
+    return encode_item(convert_item(decode_item(item)))
+
+
+def decode_item(item):
+    """Opens the image of an item, the first step of converting it.  Returns the job passed to convert_item."""
+    job = {'item': item, 'seconds': 0.0, 'value': None, 'error': None}
+    return _run_step(job, lambda: Image.open(item['image']).convert("RGBA"))
+
+
+def convert_item(job):
+    """Converts the decoded image of a job to an image of text."""
+    item = job['item']
+
+    def convert():
+        # processors extend the argument list they are given, every item gets its own copy
+        arguments = None if item['processor_arguments'] is None else list(item['processor_arguments'])
+        return TextProcessor.process(job['value'], _text, _font, _options['margin'], item['char_threshold'],
+                                     _options['background_color'], _options['processor'], arguments, False,
+                                     _options['renderer'], cache=_options['cache'],
+                                     glyph_cache=_options['glyph_cache'],
+                                     scaler_resample=_options['scaler_resample'])
+    return _run_step(job, convert)
+
+
+def encode_item(job):
+    """Saves the converted image of a job and returns the result dict of its item."""
+    item = job['item']
+
+    def encode():
+        os.makedirs(os.path.dirname(item['output']) or '.', exist_ok=True)
+        ImageEncoder.save_image(job['value'], item['output'], compress_level=_options['compress_level'],
+                                quality=_options['quality'])
+    _run_step(job, encode)
+
+    result = {'image': item['image'], 'output': item['output']}
+    if job['error'] is None:
+        result.update(status='ok', error=None)
+    else:
+        result.update(status='failed', error=job['error'])
+    result['seconds'] = job['seconds']
+    logging.info('[%s] [%s] in [%.2f]s', result['status'], item['image'], result['seconds'])
+    return result
+
+
+def _run_step(job, step):
+    """
+    Runs a step of a job unless an earlier step failed, recording the error if it fails.  Only the time spent in the
+    steps is added to the job's seconds, not the time it waits between pipeline stages.
+    """
+    if job['error'] is not None:
+        return job
+    start = time.perf_counter()
+    try:
+        job['value'] = step()
+    except Exception as ex:
+        logging.exception('unable to process [%s]', job['item']['image'])
+        job['value'], job['error'] = None, '%s: %s' % (type(ex).__name__, ex)
+    job['seconds'] += time.perf_counter() - start
+    return job
+
+
+def _init_worker(text, font, options):
+    global _text, _font, _options
+    _text = text
+    _font = TextProcessor.get_font(font)
+    _options = options
+    TextProcessor.get_processor_classes(options['processor'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import PIL
+from PIL import Image
+
+import TextProcessor
+import text_painter.ImageScaler as ImageScaler
+import text_painter.TextPainter as TextPainter
+from utils.Pixels import get_pixel_array
+from utils.TextSource import TextSource
+
+# (image width, image height, text length) of every size, from a thumbnail up to tens of megapixels and multi-MB texts
+SIZES = {
+    'tiny': (256, 256, 2000),
+    'small': (1024, 1024, 20000),
+    'medium': (4096, 3072, 150000),
+    'large': (8000, 5000, 1000000),
+    'huge': (10000, 8000, 4000000),
+}
+STAGES = ['text', 'processor_init', 'scale', 'pixel_scan', 'process', 'paint', 'encode']
+# the characters of the synthetic texts and how often each appears, includes a few multi-byte characters
+TEXT_ALPHABET = 'etaoinshrdlcumwfgypbvkjxqz' + ' ' + '.,;\'"-!?\n' + 'éü—'
+TEXT_WEIGHTS = np.array([12.7, 9.1, 8.2, 7.5, 7.0, 6.7, 6.3, 6.1, 6.0, 4.3, 4.0, 2.8, 2.8, 2.4, 2.4, 2.2, 2.0, 2.0,
+                         1.9, 1.5, 1.0, 0.8, 0.2, 0.2, 0.1, 0.1] + [18.0] + [1.0, 1.0, 0.2, 0.3, 0.3, 0.2, 0.1, 0.1, 0.5]
+                        + [0.1, 0.05, 0.05])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Times the scaler, processor and painter on synthetic images and texts of increasing size')
+    parser.add_argument('-s', '--sizes', nargs='+', choices=list(SIZES), default=['tiny', 'small', 'medium'],
+                        help='The sizes to run. (default: tiny small medium)')
+    parser.add_argument('-f', '--font', nargs=3, default=[os.path.join('.', 'fonts', 'JetBrainsMono', '2.304', 'fonts', 'ttf', 'JetBrainsMono-Regular.ttf'), 8, 14],
+                        help='Font to be used, see TextProcessor.py. (default: (JetBrainsMono-Regular.ttf, 8, 14))')
+    parser.add_argument('-p', '--processor', default='DuotoneProcessor',
+                        help='The processor to benchmark. (default: DuotoneProcessor)')
+    parser.add_argument('-r', '--renderer', choices=TextPainter.RENDERERS, default='atlas',
+                        help='The renderer to benchmark. (default: atlas)')
+    parser.add_argument('--scaler_resample', choices=ImageScaler.RESAMPLE_MODES, default='pyramid',
+                        help='The scaler resample mode to benchmark, see TextProcessor.py. (default: pyramid)')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='The number of processes used to paint the text. (default: 1)')
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help='The number of times every stage is timed, the fastest run is reported. (default: 3)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='The seed of the synthetic images and texts. (default: 0)')
+    parser.add_argument('-o', '--output', help='A file to write the results to as JSON')
+    parser.add_argument('--baseline', help='A results file of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='The relative slowdown or memory growth over the baseline reported as a regression. '
+                        '(default: 0.1)')
+    parser.add_argument('--min_seconds', type=float, default=0.01,
+                        help='Slowdowns smaller than this many seconds are never reported as a regression, they are '
+                        'usually noise. (default: 0.01)')
+    parser.add_argument('--logging', help='Logging level possible values: [DEBUG, INFO, WARNING, ERROR, '
+                        'CRITICAL] (default: INFO)')
+    args = TextProcessor.normalize_args(parser.parse_args())
+    # the pipeline logs every step, only the benchmark's own messages are interesting here
+    benchmark_level = logging.getLogger().level
+    font = TextProcessor.get_font(args.font)
+
+    results = {'environment': get_environment(), 'options': {
+        'processor': args.processor, 'renderer': args.renderer, 'scaler_resample': args.scaler_resample,
+        'workers': args.workers, 'repeat': args.repeat,
+        'seed': args.seed, 'font': [os.path.basename(args.font[0]), int(args.font[1]), int(args.font[2])]},
+        'sizes': {}}
+    with tempfile.TemporaryDirectory(prefix='textify-benchmark-') as directory:
+        for name in args.sizes:
+            logging.getLogger().setLevel(benchmark_level)
+            logging.info('benchmarking size [%s] - image: [%sx%s] text: [%s]', name, *SIZES[name])
+            logging.getLogger().setLevel(max(benchmark_level, logging.WARNING))
+            results['sizes'][name] = run_size(name, font, args, directory)
+            logging.getLogger().setLevel(benchmark_level)
+            log_results(name, results['sizes'][name])
+
+    if args.output:
+        with open(args.output, mode='wt', encoding='UTF-8') as file:
+            json.dump(results, file, indent=2)
+        logging.info('writing results to [%s]', os.path.abspath(args.output))
+
+    if args.baseline:
+        with open(args.baseline, encoding='UTF-8') as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.threshold, args.min_seconds)
+        for regression in regressions:
+            logging.error('regression [%s] [%s] %s: [%s] -> [%s] (%+.1f%%)', *regression[:5],
+                          (regression[4] / regression[3] - 1) * 100)
+        if regressions:
+            sys.exit(1)
+        logging.info('no regressions against [%s]', args.baseline)
+
+
+def run_size(name, font, args, directory):
+    """
+    Runs every stage of the pipeline on a synthetic image and text of the given size.  Every stage is given the
+    output of the previous stage, so the stages are timed separately but on realistic input.
+
+    Returns:
+        A dict with the timings and peak memory of every stage.
+    """
+    width, height, text_length = SIZES[name]
+    image = get_synthetic_image((width, height), args.seed)
+    text_path = os.path.join(directory, '%s.txt' % name)
+    with open(text_path, mode='wt', encoding='UTF-8', newline='') as file:
+        file.write(get_synthetic_text(text_length, args.seed))
+
+    state = {}
+
+    def load_text():
+        # every run gets an empty cache directory so the text is indexed from scratch
+        run_directory = tempfile.mkdtemp(dir=directory)
+        state['text'] = TextSource(text_path, run_directory)
+
+    def init_processor():
+        state['processor'] = TextProcessor.get_processor(args.processor, image, None)
+        state['vectorized'] = state['processor'].supports_arrays()
+
+    def scale():
+        processor = state['processor']
+        state['scaled'] = ImageScaler.scale_image_to_text(
+            state['text'], image, (font[1], font[2]), processor.should_paint_pixel,
+            processor.should_paint_array if state['vectorized'] else None, resample=args.scaler_resample)
+
+    def pixel_scan():
+        # the per pixel path processors without array support take, timed even for processors that have it
+        state['scanned'] = int(ImageScaler.get_paint_mask(state['scaled'], state['processor'].should_paint_pixel).sum())
+
+    def process():
+        processor = state['processor']
+        if state['vectorized']:
+            pixels, _ = processor.process_array(get_pixel_array(state['scaled']))
+            state['processed'] = Image.fromarray(pixels)
+        else:
+            processor.image = state['scaled']
+            processor.process()
+            state['processed'] = processor.image
+
+    def paint():
+        state['painted'] = TextPainter.get_text_image(state['text'], state['processed'], font, (0, 0), 250.0,
+                                                      (255, 255, 255), args.renderer, args.workers)
+
+    def encode():
+        state['encoded'] = len(save_png(state['painted']))
+
+    stages = {}
+    for stage, function in zip(STAGES, [load_text, init_processor, scale, pixel_scan, process, paint, encode]):
+        stages[stage] = measure(function, args.repeat)
+
+    return {'image_size': [width, height], 'text_length': text_length, 'grid_size': list(state['scaled'].size),
+            'canvas_size': list(state['painted'].size), 'encoded_bytes': state['encoded'], 'stages': stages}
+
+
+def measure(function, repeat):
+    """
+    Times the function repeat times and then runs it once more while tracing memory.  Tracing slows allocations down,
+    so it is never part of the timed runs.  Only memory allocated through Python and numpy is traced, the buffers
+    Pillow allocates for its images are not included.
+
+    Returns:
+        A dict with the fastest and median run time in seconds and the peak traced memory in bytes.
+    """
+    timings = []
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {'seconds': min(timings), 'median_seconds': statistics.median(timings), 'peak_bytes': peak}
+
+
+def compare(results, baseline, threshold, min_seconds):
+    """
+    Compares the results against a baseline.  Only sizes and stages present in both are compared.
+
+    Returns:
+        A list of (size, stage, metric, baseline value, current value) tuples of every metric that regressed by more
+        than the threshold.
+    """
+    regressions = []
+    for name, size in results['sizes'].items():
+        baseline_size = baseline.get('sizes', {}).get(name)
+        if baseline_size is None:
+            continue
+        for stage, current in size['stages'].items():
+            previous = baseline_size['stages'].get(stage)
+            if previous is None:
+                continue
+            if (current['seconds'] > previous['seconds'] * (1 + threshold)
+                    and current['seconds'] - previous['seconds'] > min_seconds):
+                regressions.append((name, stage, 'seconds', previous['seconds'], current['seconds']))
+            if previous['peak_bytes'] and current['peak_bytes'] > previous['peak_bytes'] * (1 + threshold):
+                regressions.append((name, stage, 'peak_bytes', previous['peak_bytes'], current['peak_bytes']))
+    return regressions
+
+
+def get_synthetic_image(size, seed):
+    """
+    Returns an RGBA image of overlapping color gradients with some noise, so that roughly half of it is dark enough
+    to be painted and the processor and scaler see realistic edges.
+    """
+    width, height = size
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 6 * np.pi, width, dtype=np.float32)[None, :]
+    y = np.linspace(0, 4 * np.pi, height, dtype=np.float32)[:, None]
+    pixels = np.empty((height, width, 4), dtype=np.uint8)
+    pixels[..., 3] = 255
+    for channel, phase in enumerate((0.0, 2.1, 4.2)):
+        wave = np.sin(x + phase) * np.cos(y - phase) * 110 + 128
+        wave += rng.normal(0, 12, size=(height, width)).astype(np.float32)
+        pixels[..., channel] = np.clip(wave, 0, 255)
+        del wave
+    return Image.fromarray(pixels)
+
+
+def get_synthetic_text(length, seed):
+    """Returns a random text of the given length with roughly English letter frequencies."""
+    rng = np.random.default_rng(seed)
+    codes = np.array([ord(c) for c in TEXT_ALPHABET], dtype=np.uint32)
+    indices = rng.choice(len(codes), size=length, p=TEXT_WEIGHTS / TEXT_WEIGHTS.sum())
+    return codes[indices].tobytes().decode('utf-32-le')
+
+
+def save_png(image):
+    """Returns the image encoded the way TextProcessor saves it."""
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def get_environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'pillow': PIL.__version__,
+            'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+
+def log_results(name, size):
+    logging.info('[%s] grid: [%sx%s] canvas: [%sx%s]', name, *size['grid_size'], *size['canvas_size'])
+    for stage, result in size['stages'].items():
+        logging.info('[%s] %-14s %9.3fs (median %9.3fs) peak: [%.1f]MB', name, stage, result['seconds'],
+                     result['median_seconds'], result['peak_bytes'] / (1024 * 1024))
+
+
+if __name__ == '__main__':
+    main()
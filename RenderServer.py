@@ -0,0 +1,409 @@
+import argparse
+import collections
+import io
+import json
+import logging
+import os
+import signal
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from PIL import Image
+
+import TextProcessor
+import text_painter.GlyphCache as GlyphCache
+import text_painter.ScaleCache as ScaleCache
+import text_painter.TextFormatter as TextFormatter
+import text_painter.TextPainter as TextPainter
+import utils.Metrics as Metrics
+from text_painter.GlyphAtlas import GlyphAtlas
+
+# the content type of every output format a job can ask for
+CONTENT_TYPES = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg',
+    'ansi': 'text/plain; charset=utf-8',
+    'html': 'text/html; charset=utf-8',
+    'svg': 'image/svg+xml',
+}
+
+# the total size of the finished results kept in memory above which the oldest finished jobs are dropped
+DEFAULT_KEEP_BYTES = 512 * 1024 * 1024
+
+_texts = None
+_font = None
+_cache = None
+_glyph_cache = None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Runs a local HTTP server converting images to images of text.  Fonts, texts and processors are '
+        'loaded once and jobs are rendered by a pool of worker processes')
+    parser.add_argument('-t', '--text', nargs='+', required=True,
+                        help='The text files jobs can use, as name=path or a path whose file name without extension '
+                        'is the name.  The first text is used when a job does not name one')
+    parser.add_argument('-f', '--font', nargs=3, default=[os.path.join('.', 'fonts', 'JetBrainsMono', '2.304', 'fonts', 'ttf', 'JetBrainsMono-Regular.ttf'), 8, 14],
+                        help='Font to be used.  Must include Filename of a TrueType (.ttf) font, font width in pixels when rendered at 15px, and height when rendered at 15px. (default: (JetBrainsMono-Regular.ttf, 8, 14))')
+    parser.add_argument('--host', default='127.0.0.1', help='The address to listen on. (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080, help='The port to listen on. (default: 8080)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                        help='The number of jobs rendered at the same time. (default: the number of CPUs)')
+    parser.add_argument('--max_queue', type=int, default=64,
+                        help='The most jobs waiting or rendering at once, new jobs are rejected with 503 when it is '
+                        'reached. (default: 64)')
+    parser.add_argument('--keep_jobs', type=int, default=256,
+                        help='The number of finished jobs whose results are kept, the oldest are dropped first. '
+                        'Results are kept in memory, see --keep_size. (default: 256)')
+    parser.add_argument('--keep_size', type=int, default=DEFAULT_KEEP_BYTES // (1024 * 1024),
+                        help='The total size in MB of the results of finished jobs kept in memory, the oldest jobs '
+                        'are dropped first once it is exceeded.  The newest job is always kept. (default: 512)')
+    parser.add_argument('--max_image_size', type=int, default=32,
+                        help='The largest accepted upload in MB. (default: 32)')
+    parser.add_argument('--cache', action=argparse.BooleanOptionalAction, default=True,
+                        help='Cache scaling results on disk, see TextProcessor.py. (default: --cache)')
+    parser.add_argument('--cache_dir', '--cache-dir', default=ScaleCache.DEFAULT_CACHE_DIR,
+                        help='The directory scaling results are cached in. (default: %s)' % ScaleCache.DEFAULT_CACHE_DIR)
+    parser.add_argument('--cache_size', type=int, default=ScaleCache.DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help='The size in MB above which the least recently used cached results are removed. (default: 512)')
+    parser.add_argument('--glyph_cache', action=argparse.BooleanOptionalAction, default=True,
+                        help='Keep rasterized glyphs in an atlas on disk, see TextProcessor.py. (default: --glyph_cache)')
+    parser.add_argument('--glyph_cache_dir', '--glyph-cache-dir', default=GlyphCache.DEFAULT_CACHE_DIR,
+                        help='The directory glyph atlases are stored in. (default: %s)' % GlyphCache.DEFAULT_CACHE_DIR)
+    parser.add_argument('--glyph_cache_size', type=int, default=GlyphCache.DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help='The size in MB of the glyphs kept in memory by every worker. (default: 64)')
+    parser.add_argument('--logging', help='Logging level possible values: [DEBUG, INFO, WARNING, ERROR, '
+                        'CRITICAL] (default: INFO)')
+    args = TextProcessor.normalize_args(parser.parse_args())
+
+    texts = get_texts(args.text)
+    render_queue = RenderQueue(texts, args.font, TextProcessor.get_scale_cache(args), args.workers, args.max_queue,
+                               args.keep_jobs, TextProcessor.get_glyph_cache(args), args.keep_size * 1024 * 1024)
+    server = ThreadingHTTPServer((args.host, args.port), RenderRequestHandler)
+    server.daemon_threads = True
+    server.render_queue = render_queue
+    server.max_image_bytes = args.max_image_size * 1024 * 1024
+    logging.info('serving on [http://%s:%s] with [%s] workers and texts %s', args.host, server.server_address[1],
+                 args.workers, list(texts))
+    # serve_forever has to be stopped from another thread
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info('shutting down')
+    finally:
+        server.server_close()
+        render_queue.shutdown()
+
+
+def get_texts(entries):
+    """Returns a dict of name to TextSource of the name=path or path entries, indexing every text once."""
+    texts = {}
+    for entry in entries:
+        name, separator, path = entry.partition('=')
+        if not separator:
+            name, path = os.path.splitext(os.path.basename(entry))[0], entry
+        texts[name] = TextProcessor.get_text_source(path)
+    return texts
+
+
+class RenderJob:
+    """A submitted render job and, once it finished, its result."""
+
+    def __init__(self, options):
+        self.id = uuid.uuid4().hex
+        self.options = options
+        self.submitted = time.time()
+        self.future = None
+        self.result = None
+        self.content_type = None
+        self.error = None
+        self.seconds = None
+        self.stages = None
+        self.finished = False
+
+    def get_status(self):
+        if self.finished:
+            return 'failed' if self.error is not None else 'done'
+        return 'running' if self.future is not None and self.future.running() else 'queued'
+
+    def to_dict(self):
+        return {'id': self.id, 'status': self.get_status(), 'options': self.options, 'submitted': self.submitted,
+                'seconds': self.seconds, 'stages': self.stages, 'error': self.error,
+                'result': '/jobs/%s/result' % self.id}
+
+
+class RenderQueue:
+    """
+        Renders jobs in a pool of worker processes that load the texts and font once.  At most max_queue jobs are
+        waiting or rendering at once and the results of the last keep_jobs finished jobs are kept, as long as they
+        take up no more than keep_bytes together.
+    """
+
+    def __init__(self, texts, font, cache, workers, max_queue, keep_jobs, glyph_cache=None,
+                 keep_bytes=DEFAULT_KEEP_BYTES):
+        """Initialize the RenderQueue and start the worker processes.
+
+        Args:
+            texts: A dict of name to utils.TextSource.
+            font: The font arguments, see TextProcessor.get_font.
+            cache: An optional text_painter.ScaleCache shared by every worker.
+            workers: The number of worker processes.
+            max_queue: The most unfinished jobs, submit returns None when it is reached.
+            keep_jobs: The number of finished jobs that are kept.
+            glyph_cache: An optional text_painter.GlyphCache, every worker loads the glyphs of the texts into its
+                own copy when it starts.
+            keep_bytes: The total size of the kept results above which the oldest finished jobs are dropped, the
+                newest finished job is always kept.
+        """
+        self.texts = list(texts)
+        self.max_queue = max_queue
+        self.keep_jobs = keep_jobs
+        self.keep_bytes = keep_bytes
+        self.jobs = {}
+        self.finished = collections.deque()
+        self.result_bytes = 0
+        self.pending = 0
+        self.counters = collections.Counter()
+        self.stages = collections.defaultdict(lambda: {'count': 0, 'seconds': 0.0})
+        self.lock = threading.Lock()
+        self.workers = workers
+        self.worker_args = (texts, font, cache, glyph_cache)
+        self.executor = self._start_executor()
+
+    def submit(self, image_bytes, options):
+        """
+        Queues a job, returning the RenderJob or None when the queue is full.  When a worker process died the pool is
+        restarted and BrokenProcessPool is raised, the job can be submitted again once the new workers started.
+        """
+        job = RenderJob(options)
+        with self.lock:
+            if self.pending >= self.max_queue:
+                self.counters['rejected'] += 1
+                return None
+            try:
+                job.future = self.executor.submit(_render_job, image_bytes, options)
+            except BrokenProcessPool:
+                logging.error('a worker process died, restarting the worker pool')
+                self.counters['restarts'] += 1
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = self._start_executor()
+                raise
+            self.pending += 1
+            self.counters['submitted'] += 1
+            self.jobs[job.id] = job
+        job.future.add_done_callback(lambda future: self._finish(job))
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def get_metrics(self):
+        """Returns the queue depth, job counts and the time spent in every stage by all finished jobs."""
+        with self.lock:
+            jobs = [job for job in self.jobs.values() if not job.finished]
+            running = sum(1 for job in jobs if job.future is not None and job.future.running())
+            return {'queued': len(jobs) - running, 'running': running, 'max_queue': self.max_queue,
+                    'result_bytes': self.result_bytes, 'jobs': dict(self.counters),
+                    'stages': {name: dict(stage) for name, stage in self.stages.items()},
+                    'texts': self.texts}
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    def _start_executor(self):
+        executor = ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=self.worker_args)
+        # start every worker now so the first jobs don't pay for loading the font and texts
+        for _ in range(self.workers):
+            executor.submit(_ping)
+        return executor
+
+    def _finish(self, job):
+        try:
+            job.result, job.content_type, job.seconds, job.stages = job.future.result()
+        except Exception as ex:
+            job.error = '%s: %s' % (type(ex).__name__, ex)
+            logging.error('job [%s] failed: %s', job.id, job.error)
+        else:
+            logging.info('job [%s] done in [%.3f]s', job.id, job.seconds)
+
+        with self.lock:
+            job.finished = True
+            self.pending -= 1
+            self.counters['failed' if job.error is not None else 'done'] += 1
+            for name, seconds in (job.stages or {}).items():
+                self.stages[name]['count'] += 1
+                self.stages[name]['seconds'] += seconds
+            self.finished.append(job.id)
+            self.result_bytes += len(job.result or b'')
+            while len(self.finished) > self.keep_jobs or (
+                    self.result_bytes > self.keep_bytes and len(self.finished) > 1):
+                dropped = self.jobs.pop(self.finished.popleft(), None)
+                if dropped is not None:
+                    self.result_bytes -= len(dropped.result or b'')
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    """
+        POST /jobs           Queues the uploaded image, options are passed as query parameters.  Responds 202 with
+                             the job, 400 for invalid options and 503 when the queue is full or the workers are
+                             restarting.
+        GET /jobs/<id>       The status of a job.
+        GET /jobs/<id>/result The converted image or text once the job is done, 409 while it is still rendering.
+        GET /metrics         The queue depth, job counts and time spent per stage.
+    """
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path.rstrip('/') != '/jobs':
+            return self._send_json(404, {'error': 'not found'})
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length <= 0:
+            return self._send_json(400, {'error': 'the request body must contain an image'})
+        if length > self.server.max_image_bytes:
+            return self._send_json(413, {'error': 'the image is larger than [%s] bytes' % self.server.max_image_bytes})
+        image_bytes = self.rfile.read(length)
+
+        try:
+            options = get_job_options(parse_qs(url.query), self.server.render_queue.texts)
+        except ValueError as ex:
+            return self._send_json(400, {'error': str(ex)})
+
+        try:
+            job = self.server.render_queue.submit(image_bytes, options)
+        except BrokenProcessPool:
+            return self._send_json(503, {'error': 'the workers are restarting, retry later'}, {'Retry-After': '1'})
+        if job is None:
+            return self._send_json(503, {'error': 'the queue is full, retry later'}, {'Retry-After': '1'})
+        self._send_json(202, job.to_dict(), {'Location': '/jobs/%s' % job.id})
+
+    def do_GET(self):
+        parts = [part for part in urlsplit(self.path).path.split('/') if part]
+        if parts == ['metrics']:
+            return self._send_json(200, self.server.render_queue.get_metrics())
+        if len(parts) not in (2, 3) or parts[0] != 'jobs' or (len(parts) == 3 and parts[2] != 'result'):
+            return self._send_json(404, {'error': 'not found'})
+
+        job = self.server.render_queue.get(parts[1])
+        if job is None:
+            return self._send_json(404, {'error': 'unknown job [%s]' % parts[1]})
+        if len(parts) == 2:
+            return self._send_json(200, job.to_dict())
+
+        status = job.get_status()
+        if status == 'failed':
+            return self._send_json(500, job.to_dict())
+        if status != 'done':
+            return self._send_json(409, job.to_dict())
+        self._send(200, job.content_type, job.result)
+
+    def log_message(self, format, *args):
+        logging.debug('%s - %s', self.address_string(), format % args)
+
+    def _send_json(self, code, body, headers=None):
+        self._send(code, 'application/json', json.dumps(body).encode('UTF-8'), headers)
+
+    def _send(self, code, content_type, body, headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def get_job_options(query, texts):
+    """
+    Returns the options of a job from its parsed query parameters.
+
+    Raises:
+        ValueError: An option is invalid.
+    """
+    def get(name, default=None):
+        return query[name][-1] if name in query else default
+
+    def get_numbers(name, default, count):
+        value = get(name)
+        if value is None:
+            return default
+        numbers = [int(number) for number in value.split(',')]
+        if len(numbers) != count:
+            raise ValueError('[%s] must contain %s comma separated numbers' % (name, count))
+        return numbers
+
+    options = {
+        'text': get('text', texts[0]),
+        'format': get('format', 'png'),
+        'char_threshold': float(get('char_threshold', 250.0)),
+        'background_color': get_numbers('background_color', [255, 255, 255], 3),
+        'margin': get_numbers('margin', [0, 0], 2),
+        'processor': get('processor', 'DuotoneProcessor'),
+        'processor_arguments': query.get('processor_arguments'),
+        'renderer': get('renderer', 'atlas'),
+    }
+    if options['text'] not in texts:
+        raise ValueError('unknown text [%s], expected one of %s' % (options['text'], texts))
+    if options['format'] not in CONTENT_TYPES:
+        raise ValueError('unknown format [%s], expected one of %s' % (options['format'], list(CONTENT_TYPES)))
+    if options['renderer'] not in TextPainter.RENDERERS:
+        raise ValueError('unknown renderer [%s], expected one of %s' % (options['renderer'], TextPainter.RENDERERS))
+    try:
+        TextProcessor.get_processor_classes(options['processor'])
+    except (ImportError, AttributeError):
+        raise ValueError('unknown processor [%s]' % options['processor'])
+    return options
+
+
+def _init_worker(texts, font, cache, glyph_cache):
+    global _texts, _font, _cache, _glyph_cache
+    _texts = texts
+    _font = TextProcessor.get_font(font)
+    _cache = cache
+    _glyph_cache = glyph_cache
+    if glyph_cache is not None:
+        for text in texts.values():
+            GlyphAtlas(_font[0], text.get_characters(), glyph_cache)
+    TextProcessor.get_processor_class('DuotoneProcessor')
+    Metrics.enable()
+
+
+def _ping():
+    pass
+
+
+def _render_job(image_bytes, options):
+    """Converts one image and returns (result bytes, content type, seconds, seconds spent in every stage)."""
+    Metrics.reset()
+    start = time.perf_counter()
+    with Metrics.span('stage.decode'):
+        image = Image.open(io.BytesIO(image_bytes)).convert('RGBA')
+    text_format = options['format'] if options['format'] in TextFormatter.FORMATS else None
+    arguments = None if options['processor_arguments'] is None else list(options['processor_arguments'])
+    result = TextProcessor.process(image, _texts[options['text']], _font, tuple(options['margin']),
+                                   options['char_threshold'], options['background_color'], options['processor'],
+                                   arguments, False, options['renderer'], cache=_cache, text_format=text_format,
+                                   glyph_cache=_glyph_cache)
+
+    with Metrics.span('stage.save'):
+        if text_format is not None:
+            data = result.encode('UTF-8')
+        else:
+            buffer = io.BytesIO()
+            (result if options['format'] != 'jpeg' else result.convert('RGB')).save(buffer, format=options['format'])
+            data = buffer.getvalue()
+
+    stages = {name: span['seconds'] for name, span in Metrics.get_report()['spans'].items() if name.startswith('stage.')}
+    return data, CONTENT_TYPES[options['format']], time.perf_counter() - start, stages
+
+
+if __name__ == '__main__':
+    main()
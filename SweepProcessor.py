@@ -0,0 +1,239 @@
+import argparse
+import itertools
+import json
+import logging
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageDraw, ImageFont
+
+import TextProcessor
+import text_painter.GlyphCache as GlyphCache
+import text_painter.ImageScaler as ImageScaler
+import text_painter.ScaleCache as ScaleCache
+import text_painter.TextPainter as TextPainter
+import utils.Metrics as Metrics
+from image_processor.processors.DuotoneProcessor import DuotoneProcessor
+from text_painter.GlyphAtlas import GlyphAtlas
+from utils.Pixels import get_pixel_array
+
+# the height of a label line of the contact sheet
+LABEL_LINE_HEIGHT = 13
+
+_shared = None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Converts an image to text once for every combination of character thresholds, duotone colors and '
+        'background colors.  The image is scaled and the glyphs are rasterized only once for all variants')
+    parser.add_argument(
+        '-i', '--image', help='The image file to be used', required=True)
+    parser.add_argument(
+        '-t', '--text', help='The text file to be used', required=True)
+    parser.add_argument(
+        '-o', '--output_dir', help='The directory to save the variants, the contact sheet and sweep.json to', required=True)
+    parser.add_argument('-f', '--font', nargs=3, default=[os.path.join('.', 'fonts', 'JetBrainsMono', '2.304', 'fonts', 'ttf', 'JetBrainsMono-Regular.ttf'), 8, 14],
+                        help='Font to be used.  Must include Filename of a TrueType (.ttf) font, font width in pixels when rendered at 15px, and height when rendered at 15px. (default: (JetBrainsMono-Regular.ttf, 8, 14))')
+    parser.add_argument('-m', '--margin', type=int, nargs=2, default=[
+                        0, 0], help='The number of pixels to add as a margin around the final image. Must include both a width and a height (default: 0 0)')
+    parser.add_argument('-c', '--char_threshold', nargs='+', default=['250'],
+                        help='The brightness thresholds to try, numbers or start:stop:step ranges including stop. (default: 250)')
+    parser.add_argument('--primary_color', nargs='+', default=['0,0,0'],
+                        help='The duotone primary colors to try as r,g,b. (default: 0,0,0)')
+    parser.add_argument('--secondary_color', nargs='+', default=['255,255,255'],
+                        help='The duotone secondary colors to try as r,g,b. (default: 255,255,255)')
+    parser.add_argument('-b', '--background_color', nargs='+', default=['255,255,255'],
+                        help='The background colors to try as r,g,b. (default: 255,255,255)')
+    parser.add_argument('--duotone_threshold', type=float,
+                        help='The duotone threshold shared by every variant. (default: the average brightness of the image)')
+    parser.add_argument('-r', '--renderer', choices=TextPainter.RENDERERS, default='atlas',
+                        help='How characters are painted, see TextProcessor.py. (default: atlas)')
+    parser.add_argument('--scaler_resample', choices=ImageScaler.RESAMPLE_MODES, default='pyramid',
+                        help='How the scaler resizes candidate sizes, see TextProcessor.py. (default: pyramid)')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='The number of variants painted at the same time. (default: 1)')
+    parser.add_argument('--thumbnail_width', type=int, default=256,
+                        help='The width of every variant on the contact sheet. (default: 256)')
+    parser.add_argument('--cache', action=argparse.BooleanOptionalAction, default=True,
+                        help='Cache scaling results on disk, see TextProcessor.py. (default: --cache)')
+    parser.add_argument('--cache_dir', '--cache-dir', default=ScaleCache.DEFAULT_CACHE_DIR,
+                        help='The directory scaling results are cached in. (default: %s)' % ScaleCache.DEFAULT_CACHE_DIR)
+    parser.add_argument('--cache_size', type=int, default=ScaleCache.DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help='The size in MB above which the least recently used cached results are removed. (default: 512)')
+    parser.add_argument('--glyph_cache', action=argparse.BooleanOptionalAction, default=True,
+                        help='Keep rasterized glyphs in an atlas on disk, see TextProcessor.py. (default: --glyph_cache)')
+    parser.add_argument('--glyph_cache_dir', '--glyph-cache-dir', default=GlyphCache.DEFAULT_CACHE_DIR,
+                        help='The directory glyph atlases are stored in. (default: %s)' % GlyphCache.DEFAULT_CACHE_DIR)
+    parser.add_argument('--glyph_cache_size', type=int, default=GlyphCache.DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help='The size in MB of the glyphs kept in memory. (default: 64)')
+    parser.add_argument('--logging', help='Logging level possible values: [DEBUG, INFO, WARNING, ERROR, '
+                        'CRITICAL] (default: INFO)')
+    args = TextProcessor.normalize_args(parser.parse_args())
+
+    try:
+        variants = get_variants(get_values(args.char_threshold), [get_color(c) for c in args.primary_color],
+                                [get_color(c) for c in args.secondary_color],
+                                [get_color(c) for c in args.background_color])
+    except ValueError as ex:
+        parser.error(str(ex))
+
+    logging.info("getting image from [%s] and text from [%s]", args.image, args.text)
+    image = Image.open(args.image).convert("RGBA")
+    text = TextProcessor.get_text_source(args.text)
+    font = TextProcessor.get_font(args.font)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    start = time.perf_counter()
+    results = sweep(image, text, font, tuple(args.margin), variants, args.output_dir, args.duotone_threshold,
+                    args.renderer, args.workers, TextProcessor.get_scale_cache(args), args.thumbnail_width,
+                    TextProcessor.get_glyph_cache(args), args.scaler_resample)
+    logging.info('rendered [%s] variants in [%.2f]s', len(results), time.perf_counter() - start)
+
+    sheet = get_contact_sheet([result.pop('thumbnail') for result in results], results, args.font[0])
+    sheet_path = os.path.join(args.output_dir, 'contact-sheet.png')
+    sheet.save(sheet_path)
+    with open(os.path.join(args.output_dir, 'sweep.json'), mode='wt', encoding='UTF-8') as file:
+        json.dump(results, file, indent=2)
+    logging.info('writing contact sheet to [%s]', os.path.abspath(sheet_path))
+
+
+def get_values(entries):
+    """Returns the numbers of a list of numbers and start:stop:step ranges, where stop is included."""
+    values = []
+    for entry in entries:
+        parts = [float(part) for part in entry.split(':')]
+        if len(parts) == 1:
+            values.append(parts[0])
+            continue
+        if len(parts) != 3 or parts[2] <= 0:
+            raise ValueError('invalid range [%s], expected start:stop:step with a positive step' % entry)
+        start, stop, step = parts
+        count = math.floor((stop - start) / step + 1e-9) + 1
+        values.extend(round(start + i * step, 9) for i in range(max(count, 0)))
+    return values
+
+
+def get_color(entry):
+    """Returns the (r, g, b) tuple of an r,g,b string."""
+    color = tuple(int(part) for part in entry.strip('()').split(','))
+    if len(color) != 3 or not all(0 <= value <= 255 for value in color):
+        raise ValueError('invalid color [%s], expected r,g,b between 0 and 255' % entry)
+    return color
+
+
+def get_variants(char_thresholds, primary_colors, secondary_colors, background_colors):
+    """Returns a dict with the parameters of every combination of the given values."""
+    return [{'char_threshold': char_threshold, 'primary_color': primary, 'secondary_color': secondary,
+             'background_color': background}
+            for char_threshold, primary, secondary, background in
+            itertools.product(char_thresholds, primary_colors, secondary_colors, background_colors)]
+
+
+def sweep(image, text, font, margin, variants, output_dir, duotone_threshold=None, renderer='atlas', workers=1,
+          cache=None, thumbnail_width=256, glyph_cache=None, scaler_resample='pyramid'):
+    """
+    Converts the image once for every variant.  The duotone processor is initialized, the image is scaled to the
+    text and the glyphs are rasterized once, only the colorizing and painting is done per variant.
+
+    Args:
+        image: The image.
+        text: The text, a string or a utils.TextSource.
+        font: A tuple containing (An ImageFont (should be monospaced), font pixel width, font pixel height).
+        margin: A tuple (margin width, margin height) containing the pixel margin to add a border of the image.
+        variants: A list of dicts with the char_threshold, primary_color, secondary_color and background_color of
+            every variant, see get_variants.
+        output_dir: The directory the variants are saved to.
+        duotone_threshold: The duotone threshold of every variant. default: the average brightness of the image
+        renderer: The TextPainter renderer used to paint the characters. default: atlas
+        workers: The number of processes painting variants. default: 1
+        cache: An optional text_painter.ScaleCache used to skip scaling an image that was scaled before. default: None
+        thumbnail_width: The width of the thumbnail returned for every variant. default: 256
+        glyph_cache: An optional text_painter.GlyphCache the glyphs of the shared atlas are taken from. default: None
+        scaler_resample: 'pyramid' or 'exact', how the scaler resizes candidate sizes. default: pyramid
+
+    Returns:
+        A list with a dict for every variant containing its parameters, output file, seconds and thumbnail image.
+    """
+    processor = DuotoneProcessor(image, None if duotone_threshold is None else ['None', 'None', str(duotone_threshold)])
+    with Metrics.span('stage.scale'):
+        scaled = ImageScaler.scale_image_to_text(text, image, (font[1], font[2]), processor.should_paint_pixel,
+                                                 processor.should_paint_array, cache, processor.get_cache_key(),
+                                                 scaler_resample)
+    primary = processor.should_paint_array(get_pixel_array(scaled))
+    # the processor is sent to every worker, the original image isn't needed anymore
+    processor.image = scaled
+    atlas = GlyphAtlas(font[0], text.get_characters() if hasattr(text, 'get_characters') else text, glyph_cache)
+    logging.info('sharing text grid width: [%s] height: [%s] and [%s] glyphs between [%s] variants', scaled.size[0],
+                 scaled.size[1], len(atlas.glyph_ids), len(variants))
+
+    shared = (text, font, margin, processor, primary, atlas, renderer, output_dir, thumbnail_width)
+    jobs = list(enumerate(variants))
+    if workers <= 1:
+        _init_worker(shared)
+        return [render_variant(job) for job in jobs]
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(shared,)) as executor:
+        return list(executor.map(render_variant, jobs))
+
+
+def render_variant(job):
+    """Colorizes and paints a single variant, saves it and returns its result dict."""
+    index, variant = job
+    text, font, margin, processor, primary, atlas, renderer, output_dir, thumbnail_width = _shared
+    start = time.perf_counter()
+
+    processor.primary_color, processor.secondary_color = variant['primary_color'], variant['secondary_color']
+    processed = Image.fromarray(processor.colorize(primary))
+    image = TextPainter.get_text_image(text, processed, font, margin, variant['char_threshold'],
+                                       variant['background_color'], renderer, atlas=atlas)
+    output = os.path.join(output_dir, 'variant-%03d.png' % index)
+    image.save(output)
+
+    thumbnail = image.copy()
+    thumbnail.thumbnail((thumbnail_width, thumbnail_width * image.size[1] // max(image.size[0], 1) or 1),
+                        reducing_gap=2.0)
+    seconds = time.perf_counter() - start
+    logging.info('variant [%s] saved to [%s] in [%.2f]s', index, output, seconds)
+    return dict(variant, index=index, output=output, seconds=seconds, thumbnail=thumbnail)
+
+
+def get_contact_sheet(thumbnails, variants, font_path):
+    """Returns an image with the thumbnail of every variant in a grid, each labelled with its parameters."""
+    columns = max(1, math.ceil(math.sqrt(len(thumbnails))))
+    rows = max(1, math.ceil(len(thumbnails) / columns))
+    cell_width = max(thumbnail.size[0] for thumbnail in thumbnails) if thumbnails else 1
+    thumbnail_height = max(thumbnail.size[1] for thumbnail in thumbnails) if thumbnails else 1
+    cell_height = thumbnail_height + LABEL_LINE_HEIGHT * 3 + 4
+    padding = 8
+
+    sheet = Image.new('RGB', (columns * (cell_width + padding) + padding, rows * (cell_height + padding) + padding),
+                      (48, 48, 48))
+    draw = ImageDraw.Draw(sheet)
+    label_font = ImageFont.truetype(font_path, 10)
+    for i, (thumbnail, variant) in enumerate(zip(thumbnails, variants)):
+        x = padding + (i % columns) * (cell_width + padding)
+        y = padding + (i // columns) * (cell_height + padding)
+        sheet.paste(thumbnail.convert('RGB'), (x, y))
+        labels = ['#%s char_threshold: %g' % (variant['index'], variant['char_threshold']),
+                  'duotone: %s %s' % (_format_color(variant['primary_color']), _format_color(variant['secondary_color'])),
+                  'background: %s' % _format_color(variant['background_color'])]
+        for line, label in enumerate(labels):
+            draw.text((x, y + thumbnail_height + 2 + line * LABEL_LINE_HEIGHT), label, font=label_font,
+                      fill=(230, 230, 230))
+    return sheet
+
+
+def _format_color(color):
+    return '%s,%s,%s' % tuple(color)
+
+
+def _init_worker(shared):
+    global _shared
+    _shared = shared
+
+
+if __name__ == '__main__':
+    main()
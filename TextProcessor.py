@@ -1,4 +1,5 @@
 import argparse
+import functools
 import importlib
 import logging
 import os
@@ -6,8 +7,16 @@ import sys
 
 from PIL import Image, ImageFont
 
+from image_processor.ChainProcessor import STAGE_SEPARATOR, ChainProcessor
 import text_painter.TextPainter as TextPainter
 import text_painter.ImageScaler as ImageScaler
+import text_painter.GlyphCache as GlyphCache
+import text_painter.ScaleCache as ScaleCache
+import text_painter.TextFormatter as TextFormatter
+import utils.ImageEncoder as ImageEncoder
+import utils.Metrics as Metrics
+from utils.Pixels import get_pixel_array
+from utils.TextSource import TextSource
 
 
 def main():
@@ -28,29 +37,96 @@ def main():
     parser.add_argument('-b', '--background_color', type=int, nargs=3, default=[
                         255, 255, 255], help='The RGB values of the color to use for the background of the image (default: 255 255 255)')
     parser.add_argument('-p', '--processor', default='DuotoneProcessor',
-                        help='pre-process the image using the given processor')
+                        help='pre-process the image using the given processor, or a comma separated chain of processors '
+                        'run one after another')
     parser.add_argument('-a', '--processor_arguments', nargs='*',
-                        help='a list of arguments to be passed to the processor')
+                        help='a list of arguments to be passed to the processor.  The arguments of chained processors '
+                        'are separated by a %s' % STAGE_SEPARATOR)
     parser.add_argument('--processor_only', action=argparse.BooleanOptionalAction,
                         help='Only run the processor without converting to characters. Useful for testing custom processors.')
+    parser.add_argument('-r', '--renderer', choices=TextPainter.RENDERERS, default='atlas',
+                        help='How characters are painted.  atlas rasterizes every distinct character once and blends the '
+                        'glyphs in bulk, reference draws every character separately and is much slower.  Both produce the same '
+                        'image. (default: atlas)')
+    parser.add_argument('--scaler_resample', choices=ImageScaler.RESAMPLE_MODES, default='pyramid',
+                        help='How the scaler resizes the candidate sizes it tries.  pyramid resizes them from an '
+                        'area-averaged image pyramid built once, which is much faster for large images, exact resizes '
+                        'every candidate from the full image. (default: pyramid)')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='The number of processes used to paint the text.  The canvas is split into horizontal bands '
+                        'that are painted in parallel, the image is the same for any number of workers. (default: 1)')
+    parser.add_argument('--format', choices=['image'] + TextFormatter.FORMATS,
+                        help='Write the characters as ANSI colored text, HTML or SVG instead of painting an image.  '
+                        '(default: picked from the output extension, .ans/.txt for ansi, .html, .svg, otherwise image)')
+    parser.add_argument('--stream', action=argparse.BooleanOptionalAction, default=False,
+                        help='Paint the text image in strips and write every strip to the output PNG as soon as it is '
+                        'painted instead of holding the whole image in memory.  For very large outputs. (default: --no-stream)')
+    parser.add_argument('--strip_rows', type=int, default=TextPainter.DEFAULT_STRIP_ROWS,
+                        help='The number of character rows painted at once with --stream. (default: %s)' %
+                        TextPainter.DEFAULT_STRIP_ROWS)
+    parser.add_argument('--compress_level', type=int, choices=range(10), default=ImageEncoder.DEFAULT_COMPRESS_LEVEL,
+                        metavar='{0-9}', help='The PNG compression level, 0 is fastest and 9 smallest. (default: %s)' %
+                        ImageEncoder.DEFAULT_COMPRESS_LEVEL)
+    parser.add_argument('--quality', type=int, help='The WebP and JPEG quality between 0 and 100, WebP is lossless at '
+                        '100. (default: the encoder\'s default)')
+    parser.add_argument('--cache', action=argparse.BooleanOptionalAction, default=True,
+                        help='Cache scaling results on disk so converting the same image and text again skips scaling. '
+                        '(default: --cache)')
+    parser.add_argument('--cache_dir', '--cache-dir', default=ScaleCache.DEFAULT_CACHE_DIR,
+                        help='The directory scaling results are cached in. (default: %s)' % ScaleCache.DEFAULT_CACHE_DIR)
+    parser.add_argument('--cache_size', type=int, default=ScaleCache.DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help='The size in MB above which the least recently used cached results are removed. (default: 512)')
+    parser.add_argument('--glyph_cache', action=argparse.BooleanOptionalAction, default=True,
+                        help='Keep rasterized glyphs in an atlas on disk so later runs with the same font and size don\'t '
+                        'rasterize them again, mostly useful for texts with thousands of distinct characters. '
+                        '(default: --glyph_cache)')
+    parser.add_argument('--glyph_cache_dir', '--glyph-cache-dir', default=GlyphCache.DEFAULT_CACHE_DIR,
+                        help='The directory glyph atlases are stored in. (default: %s)' % GlyphCache.DEFAULT_CACHE_DIR)
+    parser.add_argument('--glyph_cache_size', type=int, default=GlyphCache.DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help='The size in MB of the glyphs kept in memory above which the least recently used ones are '
+                        'dropped. (default: 64)')
+    parser.add_argument('--profile', help='A file to write a JSON report with the time spent in every stage and the '
+                        'number of resizes, evaluations and painted characters to')
     parser.add_argument('--logging', help='Logging level possible values: [DEBUG, INFO, WARNING, ERROR, '
                         'CRITICAL] (default: INFO)')
     args = normalize_args(parser.parse_args())
+    text_format = args.format or TextFormatter.get_format(args.output)
+    text_format = None if text_format == 'image' or args.processor_only else text_format
+    stream = args.stream and not args.processor_only and text_format is None
+    if stream and not args.output.lower().endswith('.png'):
+        parser.error('--stream can only write PNG files')
+    if args.strip_rows < 1:
+        parser.error('--strip_rows must be at least 1')
+    if args.quality is not None and not 0 <= args.quality <= 100:
+        parser.error('--quality must be between 0 and 100')
 
     logging.info(
         "getting image from [%s] and text from [%s]", args.image, args.text)
-    image = Image.open(args.image).convert("RGBA")
-    text = get_text(args.text)
-    font = (ImageFont.truetype(args.font[0], 15), int(
-        args.font[1]), int(args.font[2]))
+    if args.profile:
+        Metrics.enable()
+    with Metrics.span('stage.decode'):
+        image = Image.open(args.image).convert("RGBA")
+    with Metrics.span('stage.text'):
+        text = get_text_source(args.text)
+    font = get_font(args.font)
 
     image = process(image, text, font, (args.margin[0], args.margin[1]), float(
-        args.char_threshold), args.background_color, args.processor, args.processor_arguments, args.processor_only)
+        args.char_threshold), args.background_color, args.processor, args.processor_arguments, args.processor_only,
+        args.renderer, args.workers, get_scale_cache(args), args.output if stream else None, args.strip_rows,
+        text_format, get_glyph_cache(args), args.compress_level, args.scaler_resample)
 
-    logging.info("saving image to [%s]", args.output)
-    image.save(args.output)
+    if text_format is not None:
+        with Metrics.span('stage.save'):
+            write_to_file(image, args.output)
+    elif not stream:
+        logging.info("saving image to [%s]", args.output)
+        with Metrics.span('stage.save'):
+            ImageEncoder.save_image(image, args.output, compress_level=args.compress_level, quality=args.quality)
     logging.info("processing complete")
 
+    if args.profile:
+        Metrics.write_report(args.profile)
+
 
 def normalize_args(args):
     set_logging_level(args.logging)
@@ -58,59 +134,147 @@ def normalize_args(args):
     return args
 
 
-def process(image, text, font, margin, char_threshold, background_color, processor_name, processor_arguments, processor_only):
+def process(image, text, font, margin, char_threshold, background_color, processor_name, processor_arguments, processor_only,
+            renderer='atlas', workers=1, cache=None, stream=None, strip_rows=TextPainter.DEFAULT_STRIP_ROWS,
+            text_format=None, glyph_cache=None, compress_level=ImageEncoder.DEFAULT_COMPRESS_LEVEL,
+            scaler_resample='pyramid'):
     """
     Converts an image to a text image where each pixel is replaced by a single character.  By default the image will
     be turned into a duotone image, but a different processor can be supplied.
 
     Args:
         image: The image.
-        text: The text.
+        text: The text, a string or a utils.TextSource.
         font:  A tuple containing (An ImageFont (should be monospaced), font pixel width, font pixel height).
         margin: A tuple (margin width, margin height) containing the pixel margin to add a border of the image.
         char_threshold: A brightness threshold between 0 (black) and 255 (white).  Pixels below this threshold wont be replaced by a character and will be left blank.
         background_color: A tuple containing the RGB values to be used for the background color of the image.
         processor_name: The processor used to process the image.  Must be located in image_processor/processors and must
-            extend image_processor.Processor.py. default: DuotoneProcessor
+            extend image_processor.Processor.py.  Processors implementing process_array are run on whole arrays,
+            others pixel by pixel. default: DuotoneProcessor
         processor_arguments: A list of arguments to be passed to the processor.
         processor_only: Only run the processor and save the image without converting to characters. default: False
+        renderer: The TextPainter renderer used to paint the characters, 'atlas' or 'reference'. default: atlas
+        workers: The number of processes used to paint the characters. default: 1
+        cache: An optional text_painter.ScaleCache used to skip scaling an image that was scaled before. default: None
+        stream: A PNG filename.  When given the text image is painted strip by strip straight into the file instead of
+            being returned. default: None
+        strip_rows: The number of character rows painted at once when streaming. default: 64
+        text_format: 'ansi', 'html' or 'svg' to return the characters as formatted text instead of painting them.
+            default: None
+        glyph_cache: An optional text_painter.GlyphCache the glyphs are taken from instead of rasterizing them.
+            default: None
+        compress_level: The PNG compression level of the streamed file. default: 6
+        scaler_resample: 'pyramid' or 'exact', how the scaler resizes candidate sizes. default: pyramid
 
     Returns:
-        An image made out of the text.
+        An image made out of the text, the formatted text when a text_format is given, or None when it was streamed
+        to a file.
     """
 
-    processor_module = importlib.import_module(
-        "image_processor.processors." + processor_name)
-    processor = getattr(processor_module, processor_name)
-
-    processor = processor(image, processor_arguments)
+    with Metrics.span('stage.processor_init'):
+        processor = get_processor(processor_name, image, processor_arguments)
+    vectorized = processor.supports_arrays()
 
     if not processor_only:
-        processor.image = ImageScaler.scale_image_to_text(
-            text, processor.image, (font[1], font[2]), processor.should_paint_pixel)
+        with Metrics.span('stage.scale'):
+            processor.image = ImageScaler.scale_image_to_text(
+                text, processor.image, (font[1], font[2]), processor.should_paint_pixel,
+                processor.should_paint_array if vectorized else None, cache, processor.get_cache_key(),
+                scaler_resample)
 
-    processor.process()
+    with Metrics.span('stage.process'):
+        if vectorized:
+            pixels, _ = processor.process_array(get_pixel_array(processor.image))
+            processor.image = Image.fromarray(pixels)
+        else:
+            processor.process()
 
     if not processor_only:
-        processor.image = TextPainter.get_text_image(
-            text, processor.image, font, margin, char_threshold, background_color)
+        if text_format is not None:
+            with Metrics.span('stage.paint'):
+                return TextFormatter.format_text_image(text, processor.image, font, margin, char_threshold,
+                                                       background_color, text_format)
+
+        if stream is not None:
+            with Metrics.span('stage.paint'):
+                TextPainter.save_text_image(stream, text, processor.image, font, margin, char_threshold,
+                                            background_color, renderer, workers, strip_rows, compress_level,
+                                            glyph_cache)
+            return None
+
+        with Metrics.span('stage.paint'):
+            processor.image = TextPainter.get_text_image(
+                text, processor.image, font, margin, char_threshold, background_color, renderer, workers,
+                glyph_cache=glyph_cache)
 
     return processor.image
 
 
+def get_scale_cache(args):
+    """Returns the ScaleCache configured by the --cache, --cache_dir and --cache_size arguments or None."""
+    if not args.cache:
+        return None
+    return ScaleCache.ScaleCache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+
+def get_glyph_cache(args):
+    """Returns the GlyphCache configured by the --glyph_cache, --glyph_cache_dir and --glyph_cache_size arguments."""
+    return GlyphCache.GlyphCache(args.glyph_cache_dir if args.glyph_cache else None, args.glyph_cache_size * 1024 * 1024)
+
+
+def get_font(font):
+    """Returns the (ImageFont, font pixel width, font pixel height) tuple for the [filename, width, height] font argument."""
+    return ImageFont.truetype(font[0], 15), int(font[1]), int(font[2])
+
+
+def get_processor(processor_name, image, processor_arguments):
+    """
+    Returns the processor for the image.  A comma separated list of processor names returns a ChainProcessor running
+    them one after another, its processor_arguments are split into the arguments of every stage.
+    """
+    processor_classes = get_processor_classes(processor_name)
+    if len(processor_classes) == 1:
+        return processor_classes[0](image, processor_arguments)
+    return ChainProcessor(image, processor_arguments, processor_classes)
+
+
+def get_processor_classes(processor_name):
+    """Returns the Processor class of every name in a comma separated list of processor names."""
+    return [get_processor_class(name.strip()) for name in processor_name.split(',')]
+
+
+@functools.lru_cache(maxsize=None)
+def get_processor_class(processor_name):
+    """Returns the Processor class with the given name from image_processor/processors."""
+    processor_module = importlib.import_module(
+        "image_processor.processors." + processor_name)
+    return getattr(processor_module, processor_name)
+
+
 def get_text(filename):
-    text = ""
+    lines = []
     try:
         file = open(filename, encoding='UTF-8')
         for line in file:
-            text += line.replace('\n', ' ')
+            lines.append(line.replace('\n', ' '))
     except UnicodeDecodeError as ex:
         logging.critical("Unable to process: " +
                          filename + "\n\t{0}".format(ex))
         sys.exit()
     finally:
         file.close()
-    return text
+    return ''.join(lines)
+
+
+def get_text_source(filename):
+    """Returns a memory-mapped TextSource of the file that behaves like the string returned by get_text."""
+    try:
+        return TextSource(filename)
+    except UnicodeDecodeError as ex:
+        logging.critical("Unable to process: " +
+                         filename + "\n\t{0}".format(ex))
+        sys.exit()
 
 
 def set_logging_level(log_level):
@@ -0,0 +1,144 @@
+import logging
+
+import numpy as np
+from PIL import Image
+
+from image_processor.Processor import Processor
+from utils.Pixels import apply_lookup_table, get_pixel_array
+
+# the processor_arguments token separating the arguments of one stage from the next
+STAGE_SEPARATOR = '/'
+
+
+class ChainProcessor(Processor):
+    """
+        Runs several processors one after another as a single processor, e.g. contrast, then posterize, then duotone.
+        Consecutive stages that have a lookup table are fused into one table, so they cost a single lookup per pixel
+        no matter how many there are.  The last stage decides which pixels are painted, judged on the pixels the
+        earlier stages produce, so scaling only runs the fused earlier stages and the last stage's paint decision.
+    """
+
+    def __init__(self, image, arguments, processor_classes):
+        """Initialize the ChainProcessor.  Every stage is initialized with the image processed by the stages before it.
+
+        Args:
+            image: The image to process.
+            arguments: The arguments of every stage, separated by STAGE_SEPARATOR tokens, e.g. ['2', '/', '4'] passes
+                ['2'] to the first stage and ['4'] to the second.  Stages without arguments use their defaults.
+            processor_classes: The Processor class of every stage, in order.
+        """
+        if not processor_classes:
+            raise ValueError('a processor chain needs at least one processor')
+
+        self.stages = []
+        current = image
+        for i, (processor_class, stage_arguments) in enumerate(
+                zip(processor_classes, split_arguments(arguments, len(processor_classes)))):
+            stage = processor_class(current, stage_arguments)
+            self.stages.append(stage)
+            if i < len(processor_classes) - 1:
+                current = _run_steps_on_image(current, get_steps([stage]))
+        self.image = image
+        self._steps = get_steps(self.stages[:-1])
+        logging.debug('processor chain [%s] runs in [%s] steps before its last stage',
+                      ' -> '.join(type(stage).__name__ for stage in self.stages), len(self._steps))
+
+    def process(self):
+        """Processes the image through every stage."""
+        last = self.stages[-1]
+        if self.supports_arrays():
+            pixels, _ = self.process_array(get_pixel_array(self.image))
+            self.image = Image.fromarray(pixels).convert(self.image.mode)
+            return
+        last.image = _run_steps_on_image(self.image, self._steps)
+        last.process()
+        self.image = last.image
+
+    def process_array(self, pixels):
+        """
+        Processes an array of pixels through every stage.
+
+        Args:
+            pixels: An HxWx4 uint8 array of RGBA pixels.
+
+        Returns:
+            A tuple (processed HxWx4 array, HxW boolean array that is true where the last stage paints the pixel the
+            earlier stages produced)
+        """
+        return self.stages[-1].process_array(run_steps(pixels, self._steps))
+
+    def should_paint_pixel(self, pixel):
+        """Returns true if the last stage paints the pixel the earlier stages produce."""
+        if not self._steps:
+            return self.stages[-1].should_paint_pixel(pixel)
+        pixels = np.array([[tuple(pixel[:4]) + (255,) * (4 - len(pixel[:4]))]], dtype=np.uint8)
+        processed = run_steps(pixels, self._steps)[0, 0]
+        return self.stages[-1].should_paint_pixel(tuple(int(value) for value in processed))
+
+    def should_paint_array(self, pixels):
+        """Returns the HxW boolean array of the pixels the last stage paints after the earlier stages."""
+        return self.stages[-1].should_paint_array(run_steps(pixels, self._steps))
+
+    def supports_arrays(self):
+        """Returns true if the last stage can process whole arrays, earlier stages are converted as needed."""
+        return self.stages[-1].supports_arrays()
+
+    def get_cache_key(self):
+        """Every stage changes the pixels the last stage judges, so the key combines the keys of all stages."""
+        return '%s.%s[%s]' % (type(self).__module__, type(self).__qualname__,
+                              ', '.join(stage.get_cache_key() for stage in self.stages))
+
+
+def split_arguments(arguments, stage_count):
+    """Returns a list with the arguments of every stage, None for stages without arguments."""
+    stages = [[]]
+    for argument in arguments or []:
+        if argument == STAGE_SEPARATOR:
+            stages.append([])
+        else:
+            stages[-1].append(argument)
+    if len(stages) > stage_count:
+        raise ValueError('got arguments for [%s] processors but the chain has [%s]' % (len(stages), stage_count))
+    stages += [[]] * (stage_count - len(stages))
+    return [stage or None for stage in stages]
+
+
+def get_steps(stages):
+    """
+    Returns the steps running the stages.  Consecutive stages with lookup tables are fused into a single ('table',
+    table) step, other stages become ('array', stage) steps when they process arrays and ('image', stage) otherwise.
+    """
+    steps = []
+    for stage in stages:
+        table = stage.get_lookup_table()
+        if table is not None:
+            table = np.asarray(table, dtype=np.uint8)
+            if steps and steps[-1][0] == 'table':
+                # the combined table looks every value up in the first table and the result in the second
+                table = np.take_along_axis(table, steps.pop()[1].astype(np.intp), axis=1)
+            steps.append(('table', table))
+        elif stage.supports_arrays():
+            steps.append(('array', stage))
+        else:
+            steps.append(('image', stage))
+    return steps
+
+
+def run_steps(pixels, steps):
+    """Returns the HxWx4 array of pixels processed by every step."""
+    for kind, step in steps:
+        if kind == 'table':
+            pixels = apply_lookup_table(pixels, step)
+        elif kind == 'array':
+            pixels, _ = step.process_array(pixels)
+        else:
+            step.image = Image.fromarray(pixels)
+            step.process()
+            pixels = get_pixel_array(step.image)
+    return pixels
+
+
+def _run_steps_on_image(image, steps):
+    if not steps:
+        return image
+    return Image.fromarray(run_steps(get_pixel_array(image), steps)).convert(image.mode)
@@ -0,0 +1,52 @@
+import logging
+
+from PIL import Image
+
+from image_processor.Processor import Processor
+from utils.Pixels import apply_lookup_table, get_pixel_array, should_paint_pixel, should_paint_pixels
+
+
+class LookupProcessor(Processor):
+    """
+        Base class of processors that map every value of each RGBA channel through a lookup table, like adjusting the
+        contrast or posterizing.  Subclasses only build the table in get_lookup_table.  Pixels whose processed
+        brightness is below the threshold attribute are painted.
+    """
+
+    threshold = 255
+
+    def process(self):
+        """Processes the image through the lookup table."""
+        pixels, _ = self.process_array(get_pixel_array(self.image))
+        self.image = Image.fromarray(pixels).convert(self.image.mode)
+
+    def process_array(self, pixels):
+        """
+        Processes an array of pixels through the lookup table.
+
+        Args:
+            pixels: An HxWx4 uint8 array of RGBA pixels.
+
+        Returns:
+            A tuple (processed HxWx4 array, HxW boolean array that is true where the processed pixel is painted)
+        """
+        logging.info('processing image using [%s] with arguments - %s', type(self).__name__,
+                     ' '.join('%s: [%s]' % (name, value) for name, value in sorted(vars(self).items())
+                              if name != 'image' and not name.startswith('_')))
+        processed = apply_lookup_table(pixels, self._get_table())
+        return processed, should_paint_pixels(processed, self.threshold)
+
+    def should_paint_pixel(self, pixel):
+        """Returns true if the processed pixel is darker than the threshold."""
+        table = self._get_table()
+        return should_paint_pixel([int(table[channel][pixel[channel]]) for channel in range(3)], self.threshold)
+
+    def should_paint_array(self, pixels):
+        """Returns an HxW boolean array that is true for every pixel whose processed pixel is darker than the threshold."""
+        return should_paint_pixels(apply_lookup_table(pixels, self._get_table()), self.threshold)
+
+    def _get_table(self):
+        table = vars(self).get('_table')
+        if table is None:
+            table = self._table = self.get_lookup_table()
+        return table
@@ -4,10 +4,22 @@ import logging
 
 from PIL import Image
 
+import utils.Metrics as Metrics
+
+# the methods of every processor that are recorded as metrics spans when metrics are enabled
+TIMED_METHODS = ('__init__', 'process', 'process_array', 'should_paint_array')
+
 
 class Processor:
     """Process an image"""
 
+    def __init_subclass__(cls, **kwargs):
+        """Wraps the methods of custom processors in metrics spans named processor.<class name>.<method name>."""
+        super().__init_subclass__(**kwargs)
+        for name in TIMED_METHODS:
+            if name in vars(cls):
+                setattr(cls, name, Metrics.timed('processor.%s.%s' % (cls.__name__, name.strip('_')))(vars(cls)[name]))
+
     def __init__(self, image, arguments):
         """Init method called by TextProcessor to setup processor variables.  This method needs to be implemented by custom processors."""
         pass
@@ -20,6 +32,47 @@ class Processor:
         """Method called during image scaling to determine if a pixel will paint a character or skip.  This method needs to be implemented by custom processors."""
         pass
 
+    def process_array(self, pixels):
+        """
+        Vectorized alternative to process and should_paint_pixel.  Processors that implement it are run on whole
+        arrays instead of pixel by pixel.  This method is optional for custom processors, supports_arrays tells
+        whether it was implemented.
+
+        Args:
+            pixels: An HxWx4 uint8 array containing the RGBA pixels of the image.
+
+        Returns:
+            A tuple (processed HxWx4 uint8 array, HxW boolean array that is true where should_paint_pixel would be true
+            for the original pixel).
+        """
+        pass
+
+    def should_paint_array(self, pixels):
+        """Returns the HxW boolean paint mask of an HxWx4 array.  Only used when process_array is implemented."""
+        return self.process_array(pixels)[1]
+
+    def get_lookup_table(self):
+        """
+        Returns a 4x256 uint8 array holding the processed value of every value of each RGBA channel, for processors
+        where every output channel only depends on the same input channel.  A ChainProcessor fuses consecutive stages
+        that have a lookup table into a single lookup.  Other processors return None.
+        """
+        return None
+
+    def supports_arrays(self):
+        """Returns true if the processor implements the vectorized process_array method."""
+        return type(self).process_array is not Processor.process_array
+
+    def get_cache_key(self):
+        """
+        Returns a string identifying everything should_paint_pixel depends on, used to cache scaling results.  By
+        default every attribute except the image and private attributes is included.  Processors should override it
+        to leave out attributes that don't change which pixels are painted.
+        """
+        attributes = sorted((name, value) for name, value in vars(self).items()
+                            if name != 'image' and not name.startswith('_'))
+        return '%s.%s%r' % (type(self).__module__, type(self).__qualname__, attributes)
+
     def get_arguments(self, arguments, defaults):
         """Returns the list of arguments where default values are used if an argument value is not provided."""
         arguments = [] if arguments is None else arguments
@@ -0,0 +1,31 @@
+import numpy as np
+
+from image_processor.LookupProcessor import LookupProcessor
+
+
+class ContrastProcessor(LookupProcessor):
+    """
+        Increases or decreases the contrast of an image by stretching every color channel away from or towards a
+        midpoint.  A factor above 1 increases the contrast, a factor between 0 and 1 decreases it.  Alpha is kept.
+    """
+
+    def __init__(self, image, arguments):
+        """Initialize the ContrastProcessor.
+
+        Args:
+            image: The image to process.
+            arguments: A list of arguments [factor, midpoint, threshold].  Omitting a value or passing None will use
+                       the default value.
+                factor: How much the distance of every channel value from the midpoint is multiplied by. default: 1.5
+                midpoint: The channel value that is kept as is. default: 128
+                threshold: Pixels with a brightness below threshold after adjusting the contrast are painted.
+                           default: 255
+        """
+        self.factor, self.midpoint, self.threshold = self.get_arguments(arguments, [1.5, 128, 255])
+        self.image = image
+
+    def get_lookup_table(self):
+        """Returns the lookup table stretching every color channel around the midpoint."""
+        values = np.arange(256)
+        channel = np.clip(np.round((values - self.midpoint) * self.factor + self.midpoint), 0, 255).astype(np.uint8)
+        return np.stack((channel, channel, channel, values.astype(np.uint8)))
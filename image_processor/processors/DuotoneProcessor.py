@@ -1,10 +1,12 @@
 import logging
 import math
 
+import numpy as np
 from PIL import Image  # type: ignore
 
+import utils.Metrics as Metrics
 from image_processor.Processor import Processor
-from utils.Pixels import get_pixel_brightness, get_pixels
+from utils.Pixels import get_pixel_array, get_pixel_brightness, should_paint_pixel, should_paint_pixels
 
 
 class DuotoneProcessor(Processor):
@@ -30,6 +32,9 @@ class DuotoneProcessor(Processor):
         self.primary_color, self.secondary_color, self.threshold = self.get_arguments(
             arguments, default_args)
         self.image = image
+        # logged once here, process_array runs for every size the scaler tries when the processor is part of a chain
+        logging.info('processing image using [%s] with arguments - threshold: [%s] primary_color: [%s] '
+                     'secondary_color: [%s]', __name__, self.threshold, self.primary_color, self.secondary_color)
 
     def process(self):
         """
@@ -38,31 +43,47 @@ class DuotoneProcessor(Processor):
         Returns:
             A duotone image
         """
-        logging.info('processing image using [%s] with arguments - threshold: [%s] primary_color: [%s] '
-                     'secondary_color: [%s]', __name__, self.threshold, self.primary_color, self.secondary_color)
+        pixels, _ = self.process_array(get_pixel_array(self.image))
+        self.image = Image.fromarray(pixels).convert(self.image.mode)
 
-        new_pixels = []
-        colored_pixel = white_pixel = 0
-        for pixel in get_pixels(self.image):
-            if self._is_primary_color(pixel, self.threshold):
-                new_pixels.append(self.primary_color)
-                colored_pixel += 1
-            else:
-                new_pixels.append(self.secondary_color)
-                white_pixel += 1
-        processed_image = Image.new(self.image.mode, self.image.size)
-        processed_image.putdata(new_pixels)
+    def process_array(self, pixels):
+        """
+        Processes an array of pixels into a duotone array.
+
+        Args:
+            pixels: An HxWx4 uint8 array of RGBA pixels.
 
+        Returns:
+            A tuple (duotone HxWx4 array, HxW boolean array that is true for primary pixels)
+        """
+        primary = self.should_paint_array(pixels)
+        processed_pixels = self.colorize(primary)
+
+        colored_pixel = int(np.count_nonzero(primary))
         logging.debug(
-            'processor - colored_pixel: [%s] white_pixel: [%s]', colored_pixel, white_pixel)
+            'processor - colored_pixel: [%s] white_pixel: [%s]', colored_pixel, primary.size - colored_pixel)
 
-        self.image = processed_image
+        return processed_pixels, primary
+
+    def colorize(self, primary):
+        """Returns the HxWx4 duotone array of an HxW boolean array that is true for primary pixels."""
+        return np.where(primary[..., None], self._to_rgba(self.primary_color),
+                        self._to_rgba(self.secondary_color)).astype(np.uint8)
 
     def should_paint_pixel(self, pixel):
         """Method called during image scaling to determine if a pixel will paint a character or skip.  This method needs to be implemented by custom processors."""
         return self._is_primary_color(pixel, self.threshold)
 
+    def should_paint_array(self, pixels):
+        """Returns an HxW boolean array that is true for every pixel that is considered primary."""
+        return should_paint_pixels(pixels, self.threshold)
+
+    def get_cache_key(self):
+        """Only the threshold decides which pixels are painted, changing the colors keeps cached scaling results."""
+        return '%s.%s(threshold=%r)' % (type(self).__module__, type(self).__qualname__, self.threshold)
+
     @staticmethod
+    @Metrics.timed('processor.average_color')
     def _get_average_color(image):
         temp_image = image.resize((1, 1), Image.LANCZOS)
         return temp_image.getpixel((0, 0))
@@ -75,5 +96,9 @@ class DuotoneProcessor(Processor):
         Returns:
             true if the pixel should be the primary color, false otherwise.
         """
-        pixel_brightness = get_pixel_brightness(pixel)
-        return pixel_brightness < threshold
+        return should_paint_pixel(pixel, threshold)
+
+    @staticmethod
+    def _to_rgba(color):
+        """Returns the color as an RGBA tuple, colors without an alpha value are opaque."""
+        return tuple(color) + (255,) * (4 - len(color))
@@ -0,0 +1,32 @@
+import numpy as np
+
+from image_processor.LookupProcessor import LookupProcessor
+
+
+class PosterizeProcessor(LookupProcessor):
+    """
+        Reduces every color channel of an image to a number of evenly spaced levels, giving it flat areas of color.
+        Alpha is kept.
+    """
+
+    def __init__(self, image, arguments):
+        """Initialize the PosterizeProcessor.
+
+        Args:
+            image: The image to process.
+            arguments: A list of arguments [levels, threshold].  Omitting a value or passing None will use the default
+                       value.
+                levels: The number of values every color channel is reduced to, between 2 and 256. default: 4
+                threshold: Pixels with a brightness below threshold after posterizing are painted. default: 255
+        """
+        self.levels, self.threshold = self.get_arguments(arguments, [4, 255])
+        if not 2 <= self.levels <= 256:
+            raise ValueError('levels must be between 2 and 256, got [%s]' % self.levels)
+        self.image = image
+
+    def get_lookup_table(self):
+        """Returns the lookup table rounding every color channel to the nearest level."""
+        values = np.arange(256)
+        steps = self.levels - 1
+        channel = np.round(np.round(values * steps / 255) * 255 / steps).astype(np.uint8)
+        return np.stack((channel, channel, channel, values.astype(np.uint8)))
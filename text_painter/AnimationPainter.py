@@ -0,0 +1,124 @@
+import math
+
+import numpy as np
+
+from text_painter.GlyphAtlas import GlyphAtlas
+from text_painter.TextPainter import get_text_slice
+from utils.Pixels import should_paint_pixels
+
+
+class AnimationPainter:
+    """
+        Paints the frames of an animation that share one text grid.  Every cell that is painted in any frame is given
+        its character up front so the text stays in place from frame to frame, and each frame only repaints the cells
+        whose color or painted state changed since the previous frame.  Every frame is identical to painting it from
+        scratch.
+    """
+
+    def __init__(self, text, layout_mask, font, margin, threshold, background_color):
+        """Initialize the AnimationPainter.
+
+        Args:
+            text: The text to paint, a string or a utils.TextSource.
+            layout_mask: An HxW boolean array that is true for every cell painted in at least one frame.
+            font: A tuple containing (An ImageFont (should be monospaced), font pixel width, font pixel height).
+            margin: A tuple (margin width, margin height) containing the pixel margin to add a border of the image.
+            threshold: The value representing the maximum brightness that will be represented by text.
+            background_color: A tuple containing the RGB values to be used for the background color of the image.
+        """
+        height, width = layout_mask.shape
+        self.font = font
+        self.margin = margin
+        self.threshold = threshold
+        self.background_color = (background_color[0], background_color[1], background_color[2], 255)
+        self.size = (width * font[1] + margin[0] * 2, math.ceil(height * font[2]) + margin[1] * 2)
+
+        rows, columns = np.nonzero(layout_mask)
+        self.atlas = GlyphAtlas(font[0])
+        self.glyphs = np.full(layout_mask.shape, -1, dtype=np.int64)
+        self.glyphs[rows, columns] = self.atlas.get_glyph_indices(get_text_slice(text, 0, len(rows)))
+
+        # the canvas is covered by an extended grid of cells so glyphs spilling into the margins can be tracked
+        self.extended_origin = (math.ceil(margin[0] / font[1]), math.ceil(margin[1] / font[2]))
+        self.extended_size = (math.ceil((self.size[0] - margin[0]) / font[1]) + self.extended_origin[0],
+                              math.ceil((self.size[1] - margin[1]) / font[2]) + self.extended_origin[1])
+        top, left, bottom, right = self.atlas.footprint
+        self.reach = (math.floor(top / font[2]), math.ceil(bottom / font[2]),
+                      math.floor(left / font[1]), math.ceil(right / font[1]))
+
+        self.canvas = None
+        self.pixels = None
+        self.mask = None
+
+    def paint(self, pixels):
+        """
+        Paints the next frame.
+
+        Args:
+            pixels: An HxWx4 uint8 array containing the processed pixels of the frame.
+
+        Returns:
+            A tuple (HxWx4 uint8 canvas of the frame, number of cells repainted).
+        """
+        mask = should_paint_pixels(pixels, self.threshold) & (self.glyphs >= 0)
+        if self.canvas is None:
+            changed = np.ones(mask.shape, dtype=bool)
+        else:
+            changed = (mask != self.mask) | (mask & np.any(pixels != self.pixels, axis=2))
+
+        if changed.any():
+            self.canvas = self._repaint(pixels, mask, changed)
+        self.pixels, self.mask = pixels, mask
+        return self.canvas, int(np.count_nonzero(changed))
+
+    def _repaint(self, pixels, mask, changed):
+        """Repaints every canvas pixel a changed cell can touch, using every painted cell that touches those pixels."""
+        reach_top, reach_bottom, reach_left, reach_right = self.reach
+        origin_x, origin_y = self.extended_origin
+        height, width = mask.shape
+
+        changed_cells = np.zeros((self.extended_size[1], self.extended_size[0]), dtype=bool)
+        changed_cells[origin_y:origin_y + height, origin_x:origin_x + width] = changed
+        dirty_cells = _window_any(changed_cells, (1 - reach_bottom, 1 - reach_top), (1 - reach_right, 1 - reach_left))
+        touches_dirty = _window_any(dirty_cells, (reach_top, reach_bottom), (reach_left, reach_right))
+        repaint = mask & touches_dirty[origin_y:origin_y + height, origin_x:origin_x + width]
+
+        # only the bounding box of the dirty cells is painted, then its dirty pixels are copied over the last frame
+        offset_x = origin_x * self.font[1] - self.margin[0]
+        offset_y = origin_y * self.font[2] - self.margin[1]
+        top, bottom, left, right = 0, self.size[1], 0, self.size[0]
+        if self.canvas is not None:
+            dirty_rows, dirty_columns = np.nonzero(dirty_cells)
+            top = max(dirty_rows.min() * self.font[2] - offset_y, 0)
+            bottom = min((dirty_rows.max() + 1) * self.font[2] - offset_y, self.size[1])
+            left = max(dirty_columns.min() * self.font[1] - offset_x, 0)
+            right = min((dirty_columns.max() + 1) * self.font[1] - offset_x, self.size[0])
+
+        region = np.empty((bottom - top, right - left, 4), dtype=np.uint8)
+        region[:] = self.background_color
+        rows, columns = np.nonzero(repaint)
+        self.atlas.paint(region, (rows, columns), self.glyphs[rows, columns], pixels[rows, columns],
+                         (self.margin[0] - left, self.margin[1] - top), (self.font[1], self.font[2]))
+        if self.canvas is None:
+            return region
+
+        dirty = np.repeat(np.repeat(dirty_cells, self.font[2], axis=0), self.font[1], axis=1)
+        dirty = dirty[top + offset_y:bottom + offset_y, left + offset_x:right + offset_x]
+        # earlier frames may still be referenced by the caller, so the new frame is a copy
+        canvas = self.canvas.copy()
+        np.copyto(canvas[top:bottom, left:right], region, where=dirty[..., None])
+        return canvas
+
+
+def _window_any(mask, rows, columns):
+    """Returns an array where every cell is true if mask has a true cell in the window [row + rows[0], row + rows[1])
+    by [column + columns[0], column + columns[1]) around it."""
+    height, width = mask.shape
+    integral = np.zeros((height + 1, width + 1), dtype=np.int32)
+    np.cumsum(np.cumsum(mask, axis=0, dtype=np.int32), axis=1, out=integral[1:, 1:])
+    top = np.clip(np.arange(height) + rows[0], 0, height)
+    bottom = np.clip(np.arange(height) + rows[1], 0, height)
+    left = np.clip(np.arange(width) + columns[0], 0, width)
+    right = np.clip(np.arange(width) + columns[1], 0, width)
+    total = (integral[bottom][:, right] - integral[top][:, right] - integral[bottom][:, left] + integral[top][:, left])
+    return total > 0
@@ -0,0 +1,176 @@
+import logging
+import math
+
+import numpy as np
+from PIL import Image, ImageDraw  # type: ignore
+
+import utils.Metrics as Metrics
+
+# the maximum number of cells blended in a single numpy operation, keeps temporary arrays to a few hundred MB
+CHUNK_SIZE = 32768
+
+
+class GlyphAtlas:
+    """
+        Rasterizes each distinct character of a font once into an alpha mask.  A canvas can then be painted by tinting
+        and blending those masks in bulk instead of calling ImageDraw.text once per character.  Masks are blended with
+        the same integer math Pillow uses when drawing text so the painted pixels match ImageDraw.text exactly.
+    """
+
+    def __init__(self, font, characters='', cache=None):
+        """Initialize the GlyphAtlas.
+
+        Args:
+            font: The ImageFont used to rasterize the glyphs.
+            characters: Characters to rasterize up front.  Missing characters are rasterized on demand.
+            cache: An optional text_painter.GlyphCache the glyphs are taken from instead of rasterizing them again.
+        """
+        self.font = font
+        self.cache = cache
+        self.glyph_ids = {}
+        self.offsets_y = np.zeros(0, dtype=np.int32)
+        self.offsets_x = np.zeros(0, dtype=np.int32)
+        self.alphas = np.zeros(0, dtype=np.uint8)
+        self.starts = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.footprint = (0, 0, 0, 0)
+        self.add(characters)
+
+    def add(self, characters):
+        """Rasterizes every character that isn't in the atlas yet."""
+        missing = [c for c in dict.fromkeys(characters) if c not in self.glyph_ids]
+        if not missing:
+            return
+
+        logging.debug('adding [%s] glyphs', len(missing))
+        if self.cache is None:
+            Metrics.count('painter.glyphs_rasterized', len(missing))
+            glyphs = [self._rasterize(character) for character in missing]
+        else:
+            glyphs = self.cache.get_glyphs(self.font, missing, self._rasterize)
+
+        offsets_y, offsets_x, alphas, counts = [self.offsets_y], [self.offsets_x], [self.alphas], [self.counts]
+        top, left, bottom, right = self.footprint
+        for character, (glyph_y, glyph_x, glyph_alpha) in zip(missing, glyphs):
+            self.glyph_ids[character] = len(self.glyph_ids)
+            offsets_y.append(glyph_y)
+            offsets_x.append(glyph_x)
+            alphas.append(glyph_alpha)
+            counts.append(np.array([len(glyph_alpha)], dtype=np.int64))
+            if len(glyph_alpha):
+                top, left = min(top, int(glyph_y.min())), min(left, int(glyph_x.min()))
+                bottom, right = max(bottom, int(glyph_y.max()) + 1), max(right, int(glyph_x.max()) + 1)
+
+        self.offsets_y = np.concatenate(offsets_y)
+        self.offsets_x = np.concatenate(offsets_x)
+        self.alphas = np.concatenate(alphas)
+        self.counts = np.concatenate(counts)
+        self.starts = np.cumsum(self.counts) - self.counts
+        self.footprint = (top, left, bottom, right)
+
+    def get_glyph_indices(self, text):
+        """Returns a numpy array containing the glyph index of every character of the given string."""
+        codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+        unique_codes, inverse = np.unique(codes, return_inverse=True)
+        characters = [chr(code) for code in unique_codes]
+        self.add(characters)
+        lookup = np.array([self.glyph_ids[c] for c in characters], dtype=np.int64)
+        return lookup[inverse.reshape(-1)]
+
+    def paint(self, canvas, cells, glyphs, colors, origin, cell_size):
+        """
+        Blends glyphs onto the canvas in the order they are given, as if each had been drawn with ImageDraw.text.
+
+        Args:
+            canvas: A writable HxWx4 uint8 RGBA array.
+            cells: A tuple (rows, columns) of arrays containing the grid position of each glyph.
+            glyphs: An array of glyph indices as returned by get_glyph_indices.
+            colors: An Nx4 uint8 array containing the RGBA color of each glyph.
+            origin: The (x, y) canvas pixel of the top left corner of grid cell (0, 0).
+            cell_size: The (width, height) in pixels of a single grid cell.
+        """
+        rows, columns = cells
+        if len(glyphs) == 0:
+            return
+
+        for group in self._get_paint_groups(rows, columns, cell_size):
+            for start in range(0, len(group), CHUNK_SIZE):
+                chunk = group[start:start + CHUNK_SIZE]
+                self._blend_cells(canvas, origin[1] + rows[chunk] * cell_size[1],
+                                  origin[0] + columns[chunk] * cell_size[0], glyphs[chunk], colors[chunk])
+
+    def _rasterize(self, character):
+        """Draws a single character with ImageDraw.text and returns the (y, x, alpha) of every non-empty pixel."""
+        scratch = Image.new('L', (1, 1))
+        left, top, right, bottom = ImageDraw.Draw(scratch).textbbox((0, 0), character, font=self.font)
+        padding = int(getattr(self.font, 'size', 16))
+        origin = (padding - min(left, 0), padding - min(top, 0))
+        scratch = Image.new('L', (origin[0] + max(right, 1) + padding, origin[1] + max(bottom, 1) + padding))
+        ImageDraw.Draw(scratch).text(origin, character, font=self.font, fill=255)
+
+        mask = np.asarray(scratch)
+        glyph_y, glyph_x = np.nonzero(mask)
+        return ((glyph_y - origin[1]).astype(np.int32), (glyph_x - origin[0]).astype(np.int32),
+                mask[glyph_y, glyph_x].astype(np.uint8))
+
+    def _get_paint_groups(self, rows, columns, cell_size):
+        """
+        Splits the glyphs into groups that can be blended at the same time.  Glyphs that spill out of their cell
+        overlap their neighbours, so overlapping glyphs are put in different groups and the groups are ordered so
+        every overlapping pair is still blended in the original order.
+        """
+        top, left, bottom, right = self.footprint
+        reach_x = max(1, math.ceil((right - left) / cell_size[0]))
+        reach_y = max(1, math.ceil((bottom - top) / cell_size[1]))
+
+        if reach_x == 1 and reach_y == 1:
+            return [np.arange(len(rows))]
+        if reach_y == 1:
+            keys = columns
+        elif reach_x == 1:
+            keys = rows
+        else:
+            keys = columns + reach_x * rows.astype(np.int64)
+
+        order = np.argsort(keys, kind='stable')
+        boundaries = np.flatnonzero(np.diff(keys[order])) + 1
+        return np.split(order, boundaries)
+
+    def _blend_cells(self, canvas, y, x, glyphs, colors):
+        """Blends a group of non-overlapping glyphs onto the canvas."""
+        counts = self.counts[glyphs]
+        total = int(counts.sum())
+        if total == 0:
+            return
+
+        cell = np.repeat(np.arange(len(glyphs)), counts)
+        index = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + self.starts[glyphs][cell]
+        pixel_y = y[cell] + self.offsets_y[index]
+        pixel_x = x[cell] + self.offsets_x[index]
+        height, width = canvas.shape[:2]
+        visible = (pixel_y >= 0) & (pixel_y < height) & (pixel_x >= 0) & (pixel_x < width)
+        if not visible.all():
+            cell, index, pixel_y, pixel_x = cell[visible], index[visible], pixel_y[visible], pixel_x[visible]
+
+        flat = canvas.reshape(-1, 4)
+        position = pixel_y.astype(np.int64) * width + pixel_x
+        blend_pixels(flat, position, colors[cell], self.alphas[index])
+
+
+def blend_pixels(flat, position, ink, alpha):
+    """
+    Blends the ink into the given pixels of a flattened RGBA canvas using the integer math Pillow uses to fill a mask.
+
+    Args:
+        flat: An Nx4 uint8 view of the canvas.
+        position: The index of each pixel to blend.  Must not contain duplicates.
+        ink: A Kx4 array containing the RGBA ink of each pixel.
+        alpha: An array containing the mask value of each pixel.
+    """
+    out = flat[position].astype(np.uint32)
+    mask = np.repeat(alpha.astype(np.uint32)[:, None], 4, axis=1)
+    # Pillow treats a fully transparent destination as if the color mask were opaque
+    transparent = (out[:, 3] == 0) & (alpha != 0)
+    mask[transparent, :3] = 255
+    value = out * (255 - mask) + ink.astype(np.uint32) * mask + 128
+    flat[position] = ((value >> 8) + value) >> 8
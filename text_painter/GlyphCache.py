@@ -0,0 +1,238 @@
+import collections
+import functools
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+import PIL
+from PIL import ImageFont  # type: ignore
+
+import utils.Metrics as Metrics
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+                                 'textify-image', 'glyphs')
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# part of every on-disk atlas name, bump it whenever a change to GlyphAtlas changes the rasterized glyphs
+RASTERIZER_VERSION = '1'
+# the on-disk layout of a glyph pixel, the offset from the glyph origin and its mask value
+PIXEL_DTYPE = np.dtype([('y', '<i4'), ('x', '<i4'), ('alpha', 'u1')])
+
+
+class GlyphCache:
+    """
+        A cache of rasterized glyphs keyed by (font file hash, font size, character), shared by every GlyphAtlas it is
+        given to.  Glyphs are kept in memory until they take up more than max_bytes, then the least recently used ones
+        are dropped.  With a directory every font and size also gets an on-disk atlas that is memory-mapped when it is
+        read, so later runs with the same font start with the glyphs already rasterized.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        """Initialize the GlyphCache.
+
+        Args:
+            directory: The directory the on-disk atlases are stored in, or None to only cache glyphs in memory.
+            max_bytes: The size of the glyphs kept in memory above which the least recently used ones are dropped.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._glyphs = collections.OrderedDict()
+        self._atlases = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # worker processes only get the settings, they reload the on-disk atlases when they need them
+        return {'directory': self.directory, 'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state['directory'], state['max_bytes'])
+
+    @staticmethod
+    def get_font_key(font):
+        """
+        Returns the key identifying the glyphs of a font: its file hash, size, face index and layout engine, or None
+        when the font wasn't loaded from a file.
+        """
+        path = getattr(font, 'path', None)
+        if not isinstance(path, (str, bytes, os.PathLike)):
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (_get_file_hash(os.fspath(path), stat.st_mtime_ns, stat.st_size), getattr(font, 'size', None),
+                getattr(font, 'index', 0), getattr(font, 'layout_engine', None))
+
+    def get_glyphs(self, font, characters, rasterize):
+        """
+        Returns the glyph of every character, rasterizing only the ones that are neither in memory nor on disk.
+
+        Args:
+            font: The ImageFont the glyphs belong to.
+            characters: A list of characters.
+            rasterize: A function returning the (y offsets, x offsets, alpha) arrays of a character's glyph.
+
+        Returns:
+            A list with the (y offsets, x offsets, alpha) arrays of every character.
+        """
+        font_key = self.get_font_key(font)
+        if font_key is None:
+            Metrics.count('painter.glyphs_rasterized', len(characters))
+            return [rasterize(character) for character in characters]
+
+        with self._lock:
+            glyphs = [self._get(font_key, character) for character in characters]
+            missing = [i for i, glyph in enumerate(glyphs) if glyph is None]
+            if missing and self.directory is not None:
+                atlas = self._get_atlas(font_key, reload=True)
+                for i in missing:
+                    glyphs[i] = self._read(atlas, characters[i])
+                    if glyphs[i] is not None:
+                        self._put(font_key, characters[i], glyphs[i])
+                missing = [i for i in missing if glyphs[i] is None]
+
+            Metrics.count('painter.glyph_cache_hits', len(characters) - len(missing))
+            Metrics.count('painter.glyphs_rasterized', len(missing))
+            if not missing:
+                return glyphs
+
+            logging.debug('glyph cache - hits: [%s] misses: [%s]', len(characters) - len(missing), len(missing))
+            rasterized = {}
+            for i in missing:
+                glyphs[i] = rasterize(characters[i])
+                rasterized[characters[i]] = glyphs[i]
+                self._put(font_key, characters[i], glyphs[i])
+            if self.directory is not None:
+                self._save(font_key, rasterized)
+            return glyphs
+
+    def clear(self):
+        """Drops every glyph held in memory.  The on-disk atlases are kept."""
+        with self._lock:
+            self._glyphs.clear()
+            self._atlases.clear()
+            self.size = 0
+
+    def _get(self, font_key, character):
+        glyph = self._glyphs.get((font_key, character))
+        if glyph is not None:
+            self._glyphs.move_to_end((font_key, character))
+        return glyph
+
+    def _put(self, font_key, character, glyph):
+        glyph_bytes = sum(array.nbytes for array in glyph)
+        if glyph_bytes > self.max_bytes:
+            return
+        self._glyphs[(font_key, character)] = glyph
+        self.size += glyph_bytes
+        while self.size > self.max_bytes:
+            _, evicted = self._glyphs.popitem(last=False)
+            self.size -= sum(array.nbytes for array in evicted)
+
+    def _get_atlas(self, font_key, reload=False):
+        """
+        Returns the (index modification time, characters dict, memory-mapped pixels) of the font's on-disk atlas.  The
+        atlas is read again when reload is set and another run has written it since it was read.
+        """
+        atlas = self._atlases.get(font_key)
+        index_path = self._get_path(font_key, '.json')
+        try:
+            modified = os.stat(index_path).st_mtime_ns
+            if atlas is not None and (not reload or atlas[0] == modified):
+                return atlas
+            with open(index_path, encoding='UTF-8') as file:
+                index = json.load(file)
+            pixels = np.load(os.path.join(self.directory, index['pixels']), mmap_mode='r')
+            if pixels.dtype != PIXEL_DTYPE:
+                raise ValueError('unexpected pixel type [%s]' % pixels.dtype)
+            atlas = (modified, index['characters'], pixels)
+        except FileNotFoundError:
+            atlas = (None, {}, np.zeros(0, dtype=PIXEL_DTYPE))
+        except (OSError, ValueError, KeyError) as ex:
+            logging.warning('ignoring unreadable glyph atlas [%s]: %s', index_path, ex)
+            atlas = (None, {}, np.zeros(0, dtype=PIXEL_DTYPE))
+        self._atlases[font_key] = atlas
+        return atlas
+
+    @staticmethod
+    def _read(atlas, character):
+        location = atlas[1].get(character)
+        if location is None:
+            return None
+        pixels = atlas[2][location[0]:location[0] + location[1]]
+        return (np.ascontiguousarray(pixels['y']), np.ascontiguousarray(pixels['x']),
+                np.ascontiguousarray(pixels['alpha']))
+
+    def _save(self, font_key, rasterized):
+        """
+        Writes a new on-disk atlas holding the glyphs already on disk and the rasterized ones.  The pixels are written
+        to a new file before the index pointing to it is replaced, so readers always see a complete atlas.  When two
+        runs write the same atlas at once the glyphs of the last one are kept.
+        """
+        _, characters, pixels = self._get_atlas(font_key, reload=True)
+        characters = dict(characters)
+        pieces = [np.asarray(pixels)]
+        start = len(pixels)
+        for character, (glyph_y, glyph_x, glyph_alpha) in rasterized.items():
+            piece = np.empty(len(glyph_alpha), dtype=PIXEL_DTYPE)
+            piece['y'], piece['x'], piece['alpha'] = glyph_y, glyph_x, glyph_alpha
+            pieces.append(piece)
+            characters[character] = [start, len(piece)]
+            start += len(piece)
+
+        name = self._get_name(font_key)
+        pixels_name = '%s.%s-%s.npy' % (name, len(characters), os.getpid())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            self._write(pixels_name, lambda file: np.save(file, np.concatenate(pieces)))
+            replaced_pixels_name = self._get_pixels_name(name)
+            self._write(name + '.json', lambda file: file.write(
+                json.dumps({'pixels': pixels_name, 'characters': characters}).encode('UTF-8')))
+        except OSError as ex:
+            logging.warning('unable to write glyph atlas [%s]: %s', name, ex)
+            return
+        logging.debug('saved [%s] glyphs to glyph atlas [%s]', len(characters), name)
+
+        # only the pixels of the replaced index are removed, pixels another run has written but not indexed yet are
+        # left alone.  Pixels of earlier atlases that are still memory-mapped stay readable until they are closed.
+        self._atlases.pop(font_key, None)
+        if replaced_pixels_name not in (None, pixels_name) and replaced_pixels_name != self._get_pixels_name(name):
+            try:
+                os.remove(os.path.join(self.directory, replaced_pixels_name))
+            except OSError:
+                pass
+
+    def _get_pixels_name(self, name):
+        """Returns the pixels file the on-disk index of the atlas points to or None."""
+        try:
+            with open(os.path.join(self.directory, name + '.json'), encoding='UTF-8') as file:
+                return json.load(file)['pixels']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _get_name(self, font_key):
+        """Returns the file name of the font's on-disk atlas, which also depends on how Pillow rasterizes glyphs."""
+        return hashlib.sha256(repr((RASTERIZER_VERSION, PIL.__version__, ImageFont.core.freetype2_version,
+                                    font_key)).encode('UTF-8')).hexdigest()[:32]
+
+    def _get_path(self, font_key, extension):
+        return os.path.join(self.directory, self._get_name(font_key) + extension)
+
+    def _write(self, file_name, write):
+        path = os.path.join(self.directory, file_name)
+        temporary_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(temporary_path, 'wb') as file:
+            write(file)
+        os.replace(temporary_path, path)
+
+
+@functools.lru_cache(maxsize=64)
+def _get_file_hash(path, modified, size):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
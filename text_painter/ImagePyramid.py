@@ -0,0 +1,61 @@
+import collections
+import logging
+
+import utils.Metrics as Metrics
+
+# a level is only used for a candidate that it is at least this many times larger than, so the final resize still
+# filters several level pixels into every candidate pixel
+MIN_LEVEL_SCALE = 2
+# the most reduced levels kept at once, the candidates of one search almost always share a single level
+MAX_CACHED_LEVELS = 2
+
+
+class ImagePyramid:
+    """
+        Area-averaged reductions of an image by powers of two, built the first time a candidate size needs them.
+        Resizing a candidate from the smallest level that is still at least MIN_LEVEL_SCALE times larger is much
+        cheaper than resizing it from the full image, while the box filtered reduction keeps every source pixel's
+        contribution.  Level k is always reduced straight from the image, so a candidate is the same whichever
+        levels happen to be cached.
+    """
+
+    def __init__(self, image, max_levels=MAX_CACHED_LEVELS):
+        """Initialize the ImagePyramid.
+
+        Args:
+            image: The full resolution image, level 0.
+            max_levels: The most reduced levels kept in memory, the least recently used level is dropped first.
+        """
+        self.image = image
+        self.max_levels = max_levels
+        self._levels = collections.OrderedDict()
+
+    def get_level_index(self, size):
+        """Returns the index of the smallest level at least MIN_LEVEL_SCALE times larger than size in both directions."""
+        width, height = self.image.size
+        index = 0
+        while (width >> (index + 1)) >= size[0] * MIN_LEVEL_SCALE and (height >> (index + 1)) >= size[1] * MIN_LEVEL_SCALE:
+            index += 1
+        return index
+
+    def get_level(self, index):
+        """Returns level index, the image reduced by 2 ** index."""
+        if index == 0:
+            return self.image
+        level = self._levels.get(index)
+        if level is not None:
+            self._levels.move_to_end(index)
+            return level
+
+        Metrics.count('scaler.pyramid_levels')
+        with Metrics.span('scaler.pyramid'):
+            level = self.image.reduce(1 << index)
+        logging.debug('built pyramid level [%s] - width: [%s] height: [%s]', index, level.size[0], level.size[1])
+        self._levels[index] = level
+        while len(self._levels) > self.max_levels:
+            self._levels.popitem(last=False)
+        return level
+
+    def resize(self, size):
+        """Returns the image resized to size, resized from the nearest level."""
+        return self.get_level(self.get_level_index(size)).resize(size)
@@ -4,21 +4,39 @@ import math
 import sys
 import pprint
 
+import numpy as np
 from PIL import Image
 
-from utils.Pixels import should_paint_pixel
+import utils.Metrics as Metrics
+from text_painter.ImagePyramid import ImagePyramid
+from utils.Pixels import get_pixel_array, iter_pixel_rows, iter_pixels, should_paint_pixel
 
+# the most candidate sizes that are resized and counted before giving up
+MAX_EVALUATIONS = 64
+# the size of the preview used to estimate the paint mask for processors that can only be evaluated pixel by pixel
+PREVIEW_PIXELS = 1 << 18
+# how candidate sizes are resized, exact resizes every candidate from the full image
+RESAMPLE_MODES = ['pyramid', 'exact']
 
-def scale_image_to_text(text, image, font_size, should_paint_pixel_func):
+
+def scale_image_to_text(text, image, font_size, should_paint_pixel_func, should_paint_array_func=None, cache=None,
+                        processor_key=None, resample='pyramid'):
     """
     Returns an image that has been scaled to account for the font ratio and so that every character of the text can
     be represented by a single pixel above the given threshold.
 
     Args:
-        text: The text to scale to.
+        text: The text to scale to, a string or a utils.TextSource.
         image: The image to be scaled.
         font_size: The (x, y) pixel size of the font where x is the width and y is the height.
         should_paint_pixel_func: The method should be implemented by the processor and is used to determine if a pixel will result in a character being painted or skipped.
+        should_paint_array_func: Optional vectorized version of should_paint_pixel_func that takes an HxWx4 array and
+            returns an HxW boolean array.  Used instead of should_paint_pixel_func when given.
+        cache: An optional text_painter.ScaleCache.  A cached result for the same inputs is returned without scaling.
+        processor_key: A string identifying the processor's paint decision, see Processor.get_cache_key.  Required
+            when a cache is given.
+        resample: 'pyramid' to resize candidates from the nearest level of an area-averaged image pyramid or 'exact'
+            to resize every candidate from the full image. default: pyramid
 
     Returns:
         An image scaled so every character of text can be represented by a single pixel.
@@ -28,15 +46,35 @@ def scale_image_to_text(text, image, font_size, should_paint_pixel_func):
     logging.debug("original - width: [%s] height: [%s] pixels: [%s]: text[%s]", image.size[0], image.size[1],
                   image.size[0] * image.size[1], len(text))
 
+    if resample not in RESAMPLE_MODES:
+        raise ValueError('unknown resample mode [%s], expected one of %s' % (resample, RESAMPLE_MODES))
+
+    if cache is not None:
+        key = cache.get_key(image, len(text), font_size, processor_key, 'resample=%s' % resample)
+        with Metrics.span('scaler.cache_get'):
+            entry = cache.get(key)
+        if entry is not None:
+            Metrics.count('scaler.cache_hits')
+            logging.info('using cached scaling result - width: [%s] height: [%s]', entry['size'][0], entry['size'][1])
+            if 'image' in entry:
+                return entry['image']
+            Metrics.count('scaler.resizes')
+            return get_resize_func(scale_for_font_ratio(image, font_size), resample)(entry['size'])
+        Metrics.count('scaler.cache_misses')
+
     image = scale_for_font_ratio(image, font_size)
     logging.debug("scaled for font ratio - width: [%s] height: [%s] pixels: [%s]", image.size[0], image.size[1],
                   image.size[0] * image.size[1])
 
     image = scale_pixel_count_to_text_count(
-        image, text, should_paint_pixel_func)
+        image, text, should_paint_pixel_func, should_paint_array_func, resample)
     logging.debug("account for empty space - width: [%s] height: [%s]: pixels: [%s]", image.size[0], image.size[1],
                   image.size[0] * image.size[1])
 
+    if cache is not None:
+        with Metrics.span('scaler.cache_put'):
+            cache.put(key, image)
+
     return image
 
 
@@ -46,90 +84,153 @@ def scale_for_font_ratio(image, font_size: tuple[int, int]):
     will stay the same.
     """
     font_pixel_ratio = font_size[1] / font_size[0]
-    return image.resize((math.ceil(image.size[0] * font_pixel_ratio), image.size[1]))
+    Metrics.count('scaler.resizes')
+    with Metrics.span('scaler.font_ratio'):
+        return image.resize((math.ceil(image.size[0] * font_pixel_ratio), image.size[1]))
+
 
+def get_resize_func(image, resample='pyramid'):
+    """Returns a function resizing the image to a given size with the resample mode, see scale_image_to_text."""
+    if resample == 'exact':
+        return image.resize
+    return ImagePyramid(image).resize
 
-def scale_pixel_count_to_text_count(image, text, should_paint_pixel_func):
+
+def scale_pixel_count_to_text_count(image, text, should_paint_pixel_func, should_paint_array_func=None,
+                                    resample='pyramid'):
     """
     Resize the image so every pixel of the image can be represented by a single character from the text.  A pixel that
     is below the given brightness threshold will be skipped and not represented by a character.
 
-    Returns a resized image.
+    The paint mask is computed once for the given image and used to estimate the painted pixel count of a candidate
+    size.  The estimate is then confirmed with a bounded bisection on the image height where every candidate is
+    resized from the given image, so the result only depends on the inputs.  With the pyramid resample mode the
+    candidates are resized from the nearest level of an image pyramid that is built once for the whole search.
+
+    Returns a resized image, the smallest one found that has at least one painted pixel for every character.
     """
     text_length = len(text)
-    max_loop = 40
-    counter = 0
-    margin = text_length * .0001
-    seen = {}
-
     logging.debug('text length: [%s]', text_length)
 
-    # scale width/hight up or down until all of the characters can be represented by a single painted pixel as determined by the processors should_paint_pixel_func
-    # It's unlikely that the amount of charaters will match exactly so get as close to an exact match without cutting off any characters.
-    while True:
-        counter += 1
-        colored_pixel_count, width, height, diff = get_image_dimensions(
-            image, should_paint_pixel_func, text_length, counter, margin)
-        seen[str(width) + ',' + str(height)] = diff
-
-        if counter > max_loop or (text_length < colored_pixel_count and abs(diff) < margin):
-            break
-
-        scalar = math.sqrt(abs(text_length / colored_pixel_count))
-        logging.debug("scaling by [%s]", scalar)
-        new_width = math.ceil(width * scalar)
-        new_height = math.ceil(height * scalar)
-        logging.debug(
-            'new width: [%s] new height: [%s]', new_width, new_height)
-
-        if str(new_width) + ',' + str(new_height) in seen:
-            new_width += int(1 * diff / abs(diff))
-            new_height += int(1 * diff / abs(diff))
-            if str(new_width) + ',' + str(new_height) in seen:
-                break
-            logging.debug(
-                'single pixel adjusted new width: [%s] and new height: [%s]', new_width, new_height)
-
-        image = image.resize((new_width, new_height))
-
-    filtered = {k: v for k, v in seen.items() if v < 0}
-    closest = max(filtered, key=lambda k: filtered[k])
-    logging.debug("closeset looping attempt: [%s]", str(closest))
-
-    # Allow for the image ratio to be off by one pixel in either direction to see if we can get a little closer
-    closest_width = int(closest.split(",")[0])
-    closest_height = int(closest.split(",")[1])
-
-    image = image.resize((closest_width+1, closest_height))
-    colored_pixel_count, width, height, diff = get_image_dimensions(
-        image, should_paint_pixel_func, text_length, counter, margin)
-    seen[str(width) + ',' + str(height)] = diff
-
-    image = image.resize((closest_width, closest_height+1))
-    colored_pixel_count, width, height, diff = get_image_dimensions(
-        image, should_paint_pixel_func, text_length, counter, margin)
-    seen[str(width) + ',' + str(height)] = diff
-
-    filtered = {k: v for k, v in seen.items() if v < 0}
-    closest = max(filtered, key=lambda k: filtered[k])
-    logging.debug("closeset after ratio wiggle: [%s]", str(closest))
-    closest_width = int(closest.split(",")[0])
-    closest_height = int(closest.split(",")[1])
-
-    return image.resize((closest_width, closest_height))
-
-
-def get_image_dimensions(image, should_paint_pixel_func, text_length, counter, margin):
-    pixels = list(image.getdata())
-    colored_pixel_count = get_colored_pixel_count(
-        pixels, should_paint_pixel_func)
+    with Metrics.span('scaler.source_mask'):
+        mask = get_source_mask(image, should_paint_pixel_func, should_paint_array_func)
+    if not mask.any():
+        raise ValueError('no pixel of the image is painted with a character, unable to fit [%s] characters' % text_length)
+    with Metrics.span('scaler.estimate'):
+        estimated_height = estimate_height(mask, image.size[0] / image.size[1], text_length)
+    logging.debug('estimated height: [%s]', estimated_height)
+
+    evaluations = {}
+    resize = get_resize_func(image, resample)
+
+    def count(height):
+        if height not in evaluations:
+            if len(evaluations) >= MAX_EVALUATIONS:
+                raise ValueError('unable to scale the image to [%s] characters in [%s] evaluations' %
+                                 (text_length, MAX_EVALUATIONS))
+            size = get_candidate_size(image.size, height)
+            Metrics.count('scaler.evaluations')
+            Metrics.count('scaler.resizes')
+            with Metrics.span('scaler.evaluate'):
+                evaluations[height] = count_colored_pixels(
+                    resize(size), should_paint_pixel_func, should_paint_array_func)
+            logging.debug('[%s] - width: [%s] height: [%s] colored_pixels: [%s] text: [%s] diff: [%s]', len(evaluations),
+                          size[0], height, evaluations[height], text_length, text_length - evaluations[height])
+        return evaluations[height]
+
+    # bracket the smallest height that paints every character by galloping away from the estimate, then bisect
+    step = max(1, round(estimated_height * .01))
+    if count(estimated_height) >= text_length:
+        low, high = estimated_height - step, estimated_height
+        while low > 0 and count(low) >= text_length:
+            high, low, step = low, low - step, step * 2
+        low = max(low, 0)
+    else:
+        low, high = estimated_height, estimated_height + step
+        while count(high) < text_length:
+            low, high, step = high, high + step, step * 2
+
+    while high - low > 1:
+        middle = (low + high) // 2
+        if count(middle) >= text_length:
+            high = middle
+        else:
+            low = middle
+
+    size = get_candidate_size(image.size, high)
+    logging.debug('closest size: [%s] after [%s] evaluations', size, len(evaluations))
+    Metrics.count('scaler.resizes')
+    with Metrics.span('scaler.final_resize'):
+        return resize(size)
+
+
+def get_candidate_size(size, height):
+    """Returns the (width, height) of a candidate with the given height that keeps the aspect ratio of size."""
+    return max(1, round(height * size[0] / size[1])), height
+
+
+def get_source_mask(image, should_paint_pixel_func, should_paint_array_func=None):
+    """
+    Returns the HxW boolean paint mask of the image.  Processors without a vectorized paint function are evaluated on
+    a preview of at most PREVIEW_PIXELS pixels since calling should_paint_pixel_func for every source pixel is slow.
+    """
     width, height = image.size
-    diff = text_length - colored_pixel_count
+    if should_paint_array_func is None and width * height > PREVIEW_PIXELS:
+        preview_scale = math.sqrt(PREVIEW_PIXELS / (width * height))
+        Metrics.count('scaler.resizes')
+        image = image.resize((max(1, round(width * preview_scale)), max(1, round(height * preview_scale))))
+    return get_paint_mask(image, should_paint_pixel_func, should_paint_array_func)
+
 
-    logging.debug('\n\n[%s] - width: [%s] height: [%s] pixels: [%s] colored_pixels: [%s] text: [%s] diff: [%s] margin: [%s]',
-                  counter, width, height, len(pixels), colored_pixel_count, text_length, diff, margin)
+def get_paint_mask(image, should_paint_pixel_func, should_paint_array_func=None):
+    """Returns the HxW boolean paint mask of the image."""
+    if should_paint_array_func is not None:
+        return should_paint_array_func(get_pixel_array(image))
+    mask = np.empty((image.size[1], image.size[0]), dtype=bool)
+    for row, pixels in enumerate(iter_pixel_rows(image)):
+        mask[row] = [bool(should_paint_pixel_func(pixel)) for pixel in pixels]
+    return mask
 
-    return colored_pixel_count, width, height, diff
+
+def estimate_height(mask, aspect_ratio, text_length):
+    """
+    Estimates the smallest image height that paints text_length characters.  A candidate cell is counted as painted
+    when most of the source pixels it covers are painted, which is read from an integral image of the mask.
+    """
+    mask_height, mask_width = mask.shape
+    integral = np.zeros((mask_height + 1, mask_width + 1), dtype=np.int32)
+    np.cumsum(np.cumsum(mask, axis=0, dtype=np.int32), axis=1, out=integral[1:, 1:])
+    painted_ratio = max(int(integral[-1, -1]), 1) / mask.size
+
+    def estimate(height):
+        width = max(1, round(height * aspect_ratio))
+        if height > mask_height or width > mask_width:
+            return painted_ratio * width * height
+        rows = np.arange(height + 1) * mask_height // height
+        columns = np.arange(width + 1) * mask_width // width
+        corners = integral[rows][:, columns]
+        painted = corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]
+        area = np.diff(rows)[:, None] * np.diff(columns)[None, :]
+        return np.count_nonzero(painted * 2 >= area)
+
+    low = 0
+    high = max(1, math.ceil(math.sqrt(text_length / (painted_ratio * aspect_ratio))))
+    while estimate(high) < text_length:
+        low, high = high, high * 2
+    while high - low > 1:
+        middle = (low + high) // 2
+        if estimate(middle) >= text_length:
+            high = middle
+        else:
+            low = middle
+    return high
+
+
+def count_colored_pixels(image, should_paint_pixel_func, should_paint_array_func=None):
+    """Returns the number of pixels of the image that will be painted with a character."""
+    if should_paint_array_func is None:
+        return get_colored_pixel_count(iter_pixels(image), should_paint_pixel_func)
+    return int(np.count_nonzero(should_paint_array_func(get_pixel_array(image))))
 
 
 def get_colored_pixel_count(pixels, should_paint_pixel_func):
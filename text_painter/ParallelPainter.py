@@ -0,0 +1,106 @@
+import collections
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# bands per worker, more bands balance uneven rows better but repaint more overlapping rows
+BANDS_PER_WORKER = 4
+# strips painted ahead of the one being written per worker when streaming, bounds the strips held in memory
+STRIPS_PER_WORKER = 2
+
+_text_canvas = None
+
+
+def render(text_canvas, workers):
+    """
+    Paints a TextCanvas with a pool of processes.  The canvas is split into horizontal bands of glyph rows, every
+    worker paints its bands into a shared memory canvas and the result is identical to painting in a single process.
+
+    Args:
+        text_canvas: The TextPainter.TextCanvas to paint.
+        workers: The number of worker processes.
+
+    Returns:
+        An HxWx4 uint8 array containing the painted canvas.
+    """
+    width, height = text_canvas.size
+    bands = get_bands(text_canvas, workers * BANDS_PER_WORKER)
+    logging.info('painting [%s] bands with [%s] workers', len(bands), workers)
+
+    memory = shared_memory.SharedMemory(create=True, size=max(width * height * 4, 1))
+    try:
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(text_canvas,)) as executor:
+            for _ in executor.map(_render_band, [(memory.name, top, bottom) for top, bottom in bands]):
+                pass
+        return np.ndarray((height, width, 4), dtype=np.uint8, buffer=memory.buf).copy()
+    finally:
+        memory.close()
+        memory.unlink()
+
+
+def get_bands(text_canvas, band_count):
+    """Splits the canvas into at most band_count (top, bottom) ranges of canvas rows aligned to glyph rows."""
+    row_count = text_canvas.pixels.shape[0]
+    band_count = max(1, min(band_count, row_count))
+    rows = [round(i * row_count / band_count) for i in range(band_count + 1)]
+    edges = [0] + [text_canvas.margin[1] + row * text_canvas.font[2] for row in rows[1:-1]] + [text_canvas.size[1]]
+    return [(edges[i], edges[i + 1]) for i in range(band_count) if edges[i] < edges[i + 1]]
+
+
+def get_strips(text_canvas, strip_rows):
+    """Splits the canvas into (top, bottom) ranges of canvas rows that each contain strip_rows glyph rows."""
+    row_count = text_canvas.pixels.shape[0]
+    edges = [text_canvas.margin[1] + row * text_canvas.font[2] for row in range(strip_rows, row_count, strip_rows)]
+    edges = [0] + edges + [text_canvas.size[1]]
+    return [(edges[i], edges[i + 1]) for i in range(len(edges) - 1) if edges[i] < edges[i + 1]]
+
+
+def iter_strips(text_canvas, strips, workers=1):
+    """
+    Paints the strips of a TextCanvas in order, yielding the HxWx4 uint8 array of every strip.  With more than one
+    worker the next strips are painted in a pool of processes while the current strip is consumed, at most
+    STRIPS_PER_WORKER strips per worker are held at once.
+    """
+    if workers <= 1:
+        for top, bottom in strips:
+            yield text_canvas.render_rows(top, bottom)
+        return
+
+    logging.info('painting [%s] strips with [%s] workers', len(strips), workers)
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(text_canvas,)) as executor:
+        pending = collections.deque()
+        strips = iter(strips)
+        for strip in strips:
+            pending.append(executor.submit(_render_strip, strip))
+            if len(pending) >= workers * STRIPS_PER_WORKER:
+                break
+        while pending:
+            rows = pending.popleft().result()
+            for strip in strips:
+                pending.append(executor.submit(_render_strip, strip))
+                break
+            yield rows
+
+
+def _init_worker(text_canvas):
+    global _text_canvas
+    _text_canvas = text_canvas
+
+
+def _render_band(band):
+    name, top, bottom = band
+    memory = shared_memory.SharedMemory(name=name)
+    try:
+        width, height = _text_canvas.size
+        canvas = np.ndarray((height, width, 4), dtype=np.uint8, buffer=memory.buf)
+        canvas[top:bottom] = _text_canvas.render_rows(top, bottom)
+        del canvas
+    finally:
+        memory.close()
+
+
+def _render_strip(strip):
+    top, bottom = strip
+    return _text_canvas.render_rows(top, bottom)
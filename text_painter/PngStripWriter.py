@@ -0,0 +1,96 @@
+import struct
+import zlib
+
+import numpy as np
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# IDAT data is buffered until it reaches this size so the file isn't split into thousands of tiny chunks
+CHUNK_SIZE = 1 << 20
+
+
+class PngStripWriter:
+    """
+        Writes an RGBA PNG one strip of rows at a time.  Every strip is compressed into the stream as soon as it is
+        written, so only the current strip has to be held in memory no matter how large the image is.  The rows are
+        stored unfiltered, the decoded pixels are the same as saving the whole image with Pillow.
+    """
+
+    def __init__(self, file, size, compress_level=6):
+        """Initialize the PngStripWriter and write the PNG header.
+
+        Args:
+            file: A filename or a binary file object to write to.
+            size: The (width, height) of the image.
+            compress_level: The zlib compression level between 0 (none) and 9 (smallest). default: 6
+        """
+        width, height = size
+        if not 0 < width < 1 << 31 or not 0 < height < 1 << 31:
+            raise ValueError('unable to write a PNG of size [%s]' % (size,))
+
+        self.size = (width, height)
+        self.rows_written = 0
+        self._owns_file = isinstance(file, (str, bytes)) or hasattr(file, '__fspath__')
+        self._file = open(file, 'wb') if self._owns_file else file
+        self._compressor = zlib.compressobj(compress_level)
+        self._pending = []
+        self._pending_size = 0
+
+        self._file.write(PNG_SIGNATURE)
+        # 8 bits per channel, color type 6 (RGBA), deflate, adaptive filtering, no interlacing
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._owns_file:
+            self._file.close()
+        return False
+
+    def write(self, rows):
+        """Compresses the next strip of rows, an HxWx4 uint8 array, into the image."""
+        height, width = rows.shape[:2]
+        if width != self.size[0] or rows.shape[2:] != (4,):
+            raise ValueError('expected rows of width [%s] with 4 channels, got shape [%s]' % (self.size[0], rows.shape))
+        if self.rows_written + height > self.size[1]:
+            raise ValueError('writing [%s] rows would exceed the image height [%s]' % (height, self.size[1]))
+
+        # every row is prefixed with filter type 0 (none)
+        scanlines = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+        scanlines[:, 1:] = rows.reshape(height, width * 4)
+        self._add_data(self._compressor.compress(scanlines.data))
+        self.rows_written += height
+
+    def close(self):
+        """Finishes the compressed stream and writes the end of the PNG."""
+        if self._compressor is None:
+            return
+        if self.rows_written != self.size[1]:
+            raise ValueError('only [%s] of [%s] rows were written' % (self.rows_written, self.size[1]))
+
+        self._add_data(self._compressor.flush())
+        self._flush_data()
+        self._write_chunk(b'IEND', b'')
+        self._compressor = None
+        if self._owns_file:
+            self._file.close()
+
+    def _add_data(self, data):
+        if data:
+            self._pending.append(data)
+            self._pending_size += len(data)
+        if self._pending_size >= CHUNK_SIZE:
+            self._flush_data()
+
+    def _flush_data(self):
+        if self._pending:
+            self._write_chunk(b'IDAT', b''.join(self._pending))
+            self._pending, self._pending_size = [], 0
+
+    def _write_chunk(self, chunk_type, data):
+        self._file.write(struct.pack('>I', len(data)))
+        self._file.write(chunk_type)
+        self._file.write(data)
+        self._file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type))))
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+import numpy as np
+from PIL import Image  # type: ignore
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+                                 'textify-image', 'scale')
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# part of every key, bump it whenever a change to ImageScaler changes the size it picks
+SCALER_VERSION = '2'
+# the size of the strips of an image hashed at a time
+HASH_STRIP_BYTES = 1 << 22
+# temporary files older than this were left by a process killed while writing them and are removed on eviction
+STALE_TEMPORARY_SECONDS = 60 * 60
+
+
+class ScaleCache:
+    """
+        An on-disk cache of ImageScaler results keyed by a hash of everything the scaling search depends on: the image
+        content, the text length, the font cell size and the processor's paint decision.  Every entry stores the
+        chosen grid size and optionally the scaled pixels.  The least recently used entries are
+        evicted once the cache grows past its size limit.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, store_pixels=True):
+        """Initialize the ScaleCache.
+
+        Args:
+            directory: The directory the entries are stored in.
+            max_bytes: The total size of the entries above which the least recently used entries are removed.
+            store_pixels: Also store the scaled pixels so a hit doesn't need to resize the image.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.store_pixels = store_pixels
+
+    @staticmethod
+    def get_key(image, text_length, font_size, processor_key, options=''):
+        """
+        Returns the cache key of a scaling search.
+
+        Args:
+            image: The image before it is scaled.
+            text_length: The length of the text.
+            font_size: The (x, y) pixel size of the font.
+            processor_key: A string identifying the processor's paint decision, see Processor.get_cache_key.
+            options: Any other scaler option that changes the result.
+        """
+        digest = hashlib.sha256()
+        digest.update(repr((SCALER_VERSION, image.mode, image.size, text_length, tuple(font_size), processor_key,
+                            options)).encode('UTF-8'))
+        # hashed a strip at a time, the digest is the same as hashing image.tobytes() without copying the whole image
+        strip_rows = max(1, HASH_STRIP_BYTES // max(len(image.getbands()) * image.size[0], 1))
+        for top in range(0, image.size[1], strip_rows):
+            digest.update(image.crop((0, top, image.size[0], min(top + strip_rows, image.size[1]))).tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached entry for the key or None.  An entry is a dict with the `size` and, when pixels were
+        stored, the scaled `image`.
+        """
+        metadata_path = self._get_path(key, '.json')
+        try:
+            with open(metadata_path, encoding='UTF-8') as file:
+                entry = {'size': tuple(json.load(file)['size'])}
+            pixels_path = self._get_path(key, '.npz')
+            if os.path.exists(pixels_path):
+                with np.load(pixels_path) as pixels:
+                    entry['image'] = Image.fromarray(pixels['pixels'])
+                os.utime(pixels_path)
+            os.utime(metadata_path)
+        except (OSError, ValueError, KeyError) as ex:
+            if os.path.exists(metadata_path):
+                logging.warning('ignoring unreadable scale cache entry [%s]: %s', key, ex)
+            return None
+
+        logging.debug('scale cache hit [%s] - size: [%s]', key, entry['size'])
+        return entry
+
+    def put(self, key, image):
+        """Stores the scaled image for the key and evicts the least recently used entries if the cache is too large."""
+        os.makedirs(self.directory, exist_ok=True)
+        if self.store_pixels:
+            self._write(key, '.npz', lambda file: np.savez_compressed(file, pixels=np.asarray(image)))
+        self._write(key, '.json', lambda file: file.write(json.dumps({'size': image.size}).encode('UTF-8')))
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is no larger than max_bytes, along with temporary files
+        that were abandoned by a process killed while writing them.
+        """
+        entries = {}
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            key, extension = os.path.splitext(name)
+            if extension not in ('.json', '.npz', '.tmp'):
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # removed by another process sharing the cache since it was listed
+                continue
+            if extension == '.tmp':
+                if now - stat.st_mtime > STALE_TEMPORARY_SECONDS:
+                    logging.debug('removing abandoned scale cache file [%s]', name)
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                continue
+            size, last_used = entries.get(key, (0, 0))
+            entries[key] = (size + stat.st_size, max(last_used, stat.st_mtime))
+
+        total = sum(size for size, _ in entries.values())
+        for key, (size, _) in sorted(entries.items(), key=lambda entry: entry[1][1]):
+            if total <= self.max_bytes:
+                break
+            logging.debug('evicting scale cache entry [%s]', key)
+            for extension in ('.json', '.npz'):
+                try:
+                    os.remove(self._get_path(key, extension))
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+    def _get_path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def _write(self, key, extension, write):
+        path = self._get_path(key, extension)
+        temporary_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(temporary_path, 'wb') as file:
+            write(file)
+        os.replace(temporary_path, path)
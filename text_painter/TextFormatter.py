@@ -0,0 +1,181 @@
+import html
+import logging
+
+import numpy as np
+
+import utils.Metrics as Metrics
+from text_painter.TextPainter import get_text_slice
+from utils.Pixels import get_pixel_array, should_paint_pixels
+
+FORMATS = ['ansi', 'html', 'svg']
+# the format picked for an output file extension when no format is given.  Other extensions like .txt need an explicit
+# format, so a plain text file name never silently gets terminal escape codes
+EXTENSIONS = {'.ans': 'ansi', '.ansi': 'ansi', '.htm': 'html', '.html': 'html', '.svg': 'svg'}
+
+
+def get_format(filename):
+    """Returns the text format matching the extension of the filename or None for image files."""
+    for extension, text_format in EXTENSIONS.items():
+        if filename.lower().endswith(extension):
+            return text_format
+    return None
+
+
+def format_text_image(text, image, font, margin, threshold, background_color, text_format):
+    """
+    Writes the character grid TextPainter would paint as text instead of rasterizing it.  Every pixel of the image
+    is a character cell, consecutive characters of the same color are merged into a single run so the output grows
+    with the number of color runs rather than the number of pixels.
+
+    Args:
+        text: The text to use when replacing pixels, a string or a utils.TextSource.
+        image: The scaled and processed image, one pixel per character.
+        font: A tuple containing (An ImageFont (should be monospaced), font pixel width, font pixel height).
+        margin: A tuple (margin width, margin height) containing the pixel margin to add a border of the image.
+            Terminals have no pixel margins, so it is ignored for ansi.
+        threshold: The value representing the maximum brightness that will be represented by text.
+        background_color: A tuple containing the RGB values to be used for the background color of the image.
+        text_format: 'ansi' for truecolor terminal escape codes, 'html' or 'svg'.
+
+    Returns:
+        The formatted text image as a string.
+    """
+    if text_format not in FORMATS:
+        raise ValueError('unknown format [%s], expected one of %s' % (text_format, FORMATS))
+
+    logging.info('converting text to [%s]', text_format)
+    with Metrics.span('formatter.runs'):
+        pixels = get_pixel_array(image)
+        mask = should_paint_pixels(pixels, threshold)
+        rows = get_grid_rows(text, mask)
+        runs, colors = get_color_runs(pixels, mask)
+    logging.debug('formatter - cells: [%s] runs: [%s] colors: [%s]', mask.size, len(runs[0]), len(colors))
+    Metrics.count('formatter.runs', len(runs[0]))
+
+    with Metrics.span('formatter.' + text_format):
+        if text_format == 'ansi':
+            return _format_ansi(rows, runs, colors, background_color)
+        if text_format == 'html':
+            return _format_html(rows, runs, colors, font, margin, background_color)
+        return _format_svg(rows, runs, colors, font, margin, background_color)
+
+
+def get_grid_rows(text, mask):
+    """Returns a string for every row of the grid where painted cells hold the next character and others a space."""
+    height, width = mask.shape
+    painted = get_text_slice(text, 0, int(np.count_nonzero(mask)))
+    codes = np.full(mask.shape, ord(' '), dtype=np.uint32)
+    codes[mask] = np.frombuffer(painted.encode('utf-32-le'), dtype=np.uint32)
+    # control characters would break the grid apart
+    codes[(codes < 0x20) | (codes == 0x7f)] = ord(' ')
+    return [codes[row].tobytes().decode('utf-32-le') for row in range(height)]
+
+
+def get_color_runs(pixels, mask):
+    """
+    Splits every row of the grid into runs of cells with the same color and painted state.
+
+    Returns:
+        A tuple ((rows, starts, ends, color indices) arrays of every run, Nx4 array of distinct colors) where the color
+        index of a run of unpainted cells is -1.
+    """
+    height, width = mask.shape
+    keys = np.ascontiguousarray(pixels).view(np.uint32)[..., 0].astype(np.int64)
+    keys[~mask] = -1
+    change = np.ones(mask.shape, dtype=bool)
+    change[:, 1:] = keys[:, 1:] != keys[:, :-1]
+    starts = np.flatnonzero(change)
+    ends = np.append(starts[1:], height * width)
+    run_keys = keys.reshape(-1)[starts]
+
+    painted = run_keys >= 0
+    distinct, inverse = np.unique(run_keys[painted], return_inverse=True)
+    color_indices = np.full(len(starts), -1, dtype=np.int64)
+    color_indices[painted] = inverse.reshape(-1)
+    colors = distinct.astype(np.uint32).view(np.uint8).reshape(-1, 4)
+    return (starts // width, starts % width, ends - starts // width * width, color_indices), colors
+
+
+def _iter_runs(rows, runs):
+    """Yields (row, start column, characters, color index) of every run."""
+    for row, start, end, color in zip(*(array.tolist() for array in runs)):
+        yield row, start, rows[row][start:end], color
+
+
+def _get_css_color(color):
+    red, green, blue, alpha = (int(value) for value in color)
+    if alpha == 255:
+        return '#%02x%02x%02x' % (red, green, blue)
+    return 'rgba(%s,%s,%s,%.3g)' % (red, green, blue, alpha / 255)
+
+
+def _get_font_style(font):
+    """Returns the CSS font family, size and the letter spacing that makes every character advance one cell."""
+    family = font[0].getname()[0] if hasattr(font[0], 'getname') else 'monospace'
+    size = getattr(font[0], 'size', font[2])
+    spacing = font[1] - font[0].getlength('M') if hasattr(font[0], 'getlength') else 0
+    return "font-family:'%s',monospace;font-size:%spx;letter-spacing:%.3gpx" % (family, size, spacing)
+
+
+def _format_ansi(rows, runs, colors, background_color):
+    background = '\x1b[48;2;%s;%s;%sm' % tuple(background_color[:3])
+    codes = ['\x1b[38;2;%s;%s;%sm' % tuple(int(value) for value in color[:3]) for color in colors]
+    pieces = []
+    current_row, current_color = -1, None
+    for row, _, characters, color in _iter_runs(rows, runs):
+        if row != current_row:
+            if current_row >= 0:
+                pieces.append('\x1b[0m\n')
+            pieces.append(background)
+            current_row, current_color = row, None
+        if color >= 0 and color != current_color:
+            pieces.append(codes[color])
+            current_color = color
+        pieces.append(characters)
+    if current_row >= 0:
+        pieces.append('\x1b[0m\n')
+    return ''.join(pieces)
+
+
+def _format_html(rows, runs, colors, font, margin, background_color):
+    styles = ''.join('.c%s{color:%s}' % (index, _get_css_color(color)) for index, color in enumerate(colors))
+    pieces = ['<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<style>\n',
+              'body{margin:0;background:%s}\n' % _get_css_color(tuple(background_color[:3]) + (255,)),
+              'pre{margin:0;padding:%spx %spx;%s;line-height:%spx}\n' % (margin[1], margin[0], _get_font_style(font),
+                                                                       font[2]),
+              styles, '\n</style>\n</head>\n<body><pre>']
+    current_row = 0
+    for row, _, characters, color in _iter_runs(rows, runs):
+        if row != current_row:
+            pieces.append('\n')
+            current_row = row
+        characters = html.escape(characters, quote=False)
+        pieces.append(characters if color < 0 else '<span class="c%s">%s</span>' % (color, characters))
+    pieces.append('</pre></body>\n</html>\n')
+    return ''.join(pieces)
+
+
+def _format_svg(rows, runs, colors, font, margin, background_color):
+    width = len(rows[0]) * font[1] + margin[0] * 2 if rows else margin[0] * 2
+    height = len(rows) * font[2] + margin[1] * 2
+    ascent = font[0].getmetrics()[0] if hasattr(font[0], 'getmetrics') else font[2]
+    styles = ''.join('.c%s{fill:%s}' % (index, _get_css_color(color)) for index, color in enumerate(colors))
+    pieces = ['<svg xmlns="http://www.w3.org/2000/svg" width="%s" height="%s" viewBox="0 0 %s %s">\n'
+              % (width, height, width, height),
+              '<style>text{%s;white-space:pre}%s</style>\n' % (_get_font_style(font), styles),
+              '<rect width="100%%" height="100%%" fill="%s"/>\n' % _get_css_color(tuple(background_color[:3]) + (255,))]
+    current_row = -1
+    for row, start, characters, color in _iter_runs(rows, runs):
+        if color < 0:
+            continue
+        if row != current_row:
+            if current_row >= 0:
+                pieces.append('</text>\n')
+            pieces.append('<text y="%s">' % (margin[1] + row * font[2] + ascent))
+            current_row = row
+        pieces.append('<tspan x="%s" class="c%s">%s</tspan>' % (margin[0] + start * font[1], color,
+                                                                 html.escape(characters, quote=False)))
+    if current_row >= 0:
+        pieces.append('</text>\n')
+    pieces.append('</svg>\n')
+    return ''.join(pieces)
@@ -1,64 +1,218 @@
 import logging
 import math
 
+import numpy as np
 from PIL import Image, ImageDraw  # type: ignore
 
-from utils.Pixels import get_pixels, should_paint_pixel
+import text_painter.ParallelPainter as ParallelPainter
+import utils.Metrics as Metrics
+from text_painter.GlyphAtlas import GlyphAtlas
+from text_painter.PngStripWriter import PngStripWriter
+from utils.Pixels import get_pixel_array, iter_pixel_rows, should_paint_pixel, should_paint_pixels
+from utils.TextSource import TextSource
 
+RENDERERS = ['atlas', 'reference']
+# the number of glyph rows painted at once when streaming the canvas to a file
+DEFAULT_STRIP_ROWS = 64
 
-def get_text_image(text, image, font, margin, threshold, background_color):
+
+def get_text_image(text, image, font, margin, threshold, background_color, renderer='atlas', workers=1, atlas=None,
+                   glyph_cache=None):
     """
     Creates an image where each pixel of the image is represented by a single character from the text.  The color of
     the pixel is preserved and only pixels with a brightness above the given threshold will not be represented by a
     character.
 
     Args:
-        text: The text to use when replacing pixels.
+        text: The text to use when replacing pixels, a string or a utils.TextSource.
         image: The image to paint.
         font: A tuple containing (An ImageFont (should be monospaced), font pixel width, font pixel height).
         margin: A tuple (margin width, margin height) containing the pixel margin to add a border of the image.
         threshold: The value representing the maximum brightness that will be represented by text.
         background_color: A tuple containing the RGB values to be used for the background color of the image.
+        renderer: 'atlas' to blend pre-rasterized glyphs in bulk or 'reference' to draw every character with
+            ImageDraw.text.  Both produce the same pixels. default: atlas
+        workers: The number of processes painting horizontal bands of the canvas.  The image is the same for any
+            number of workers. default: 1
+        atlas: A GlyphAtlas of the font to reuse, for painting many images with the same font. default: None
+        glyph_cache: An optional text_painter.GlyphCache the glyphs of a new atlas are taken from. default: None
 
     Returns:
         An image made of text.
     """
     logging.info('converting text to image')
-    logging.info('using margin: [%s], threshold: [%s], font_size: [%s]',
-                 margin, threshold, (font[1], font[2]))
-    width, height = image.size
-    text_size = len(text)
-    logging.debug('original width: [%s] height: [%s]', width, height)
-    final_image = Image.new('RGBA',
-                            (width * font[1] + margin[0] * 2,
-                             math.ceil(height * font[2]) + margin[1] * 2),
-                            (background_color[0], background_color[1], background_color[2], 255))
-    s_width, s_height = final_image.size
+    logging.info('using margin: [%s], threshold: [%s], font_size: [%s], renderer: [%s]',
+                 margin, threshold, (font[1], font[2]), renderer)
+    logging.debug('original width: [%s] height: [%s]', image.size[0], image.size[1])
+    with Metrics.span('painter.layout'):
+        canvas = TextCanvas(text, image, font, margin, threshold, background_color, renderer, atlas, glyph_cache)
+    s_width, s_height = canvas.size
 
     logging.debug(
         'scaled for character width: [%s] height: [%s]', s_width, s_height)
-    d = ImageDraw.Draw(final_image)
-    x, y = margin
-    pixel_count, text_count = (0, 0)
-
-    white_pixels = 0
 
     logging.info('painting text to canvas (this could take a while)')
-    for pixel in get_pixels(image):
-        if should_paint_pixel(pixel, threshold):
-            d.text((x, y), text[text_count %
-                   text_size], font=font[0], fill=pixel)
-            text_count += 1
+    with Metrics.span('painter.render'):
+        if workers > 1:
+            pixels = ParallelPainter.render(canvas, workers)
         else:
-            white_pixels += 1
-        x += font[1]
-        pixel_count += 1
-        if pixel_count % width == 0:
-            x = margin[0]
-            y += font[2]
+            pixels = canvas.render_rows(0, s_height)
 
+    text_count = canvas.get_painted_count()
+    Metrics.count('painter.characters', text_count)
     logging.debug(
-        'painter - painted_pixels: [%s] white_pixels: [%s]', text_count, white_pixels)
+        'painter - painted_pixels: [%s] white_pixels: [%s]', text_count, image.size[0] * image.size[1] - text_count)
+
+    logging.info('painting finished')
+    return Image.fromarray(pixels)
+
+
+def save_text_image(filename, text, image, font, margin, threshold, background_color, renderer='atlas', workers=1,
+                    strip_rows=DEFAULT_STRIP_ROWS, compress_level=6, glyph_cache=None):
+    """
+    Paints the same image as get_text_image but streams it into a PNG file strip by strip instead of returning it.
+    Only one strip of glyph rows per worker is held in memory, so the size of the canvas is not limited by memory.
+
+    Args:
+        filename: The PNG file to write.
+        text, image, font, margin, threshold, background_color, renderer, workers: See get_text_image.
+        strip_rows: The number of glyph rows painted and written at once. default: 64
+        compress_level: The zlib compression level between 0 (none) and 9 (smallest). default: 6
+        glyph_cache: See get_text_image.
+
+    Returns:
+        The (width, height) of the written image.
+    """
+    logging.info('converting text to image')
+    logging.info('using margin: [%s], threshold: [%s], font_size: [%s], renderer: [%s]',
+                 margin, threshold, (font[1], font[2]), renderer)
+    with Metrics.span('painter.layout'):
+        canvas = TextCanvas(text, image, font, margin, threshold, background_color, renderer,
+                            glyph_cache=glyph_cache)
+    strips = ParallelPainter.get_strips(canvas, strip_rows)
 
+    logging.info('streaming text to [%s] - width: [%s] height: [%s] strips: [%s]', filename, canvas.size[0],
+                 canvas.size[1], len(strips))
+    with PngStripWriter(filename, canvas.size, compress_level) as writer:
+        strip_iterator = ParallelPainter.iter_strips(canvas, strips, workers)
+        while True:
+            with Metrics.span('painter.render'):
+                rows = next(strip_iterator, None)
+            if rows is None:
+                break
+            with Metrics.span('painter.encode'):
+                writer.write(rows)
+
+    Metrics.count('painter.characters', canvas.get_painted_count())
     logging.info('painting finished')
-    return final_image
+    return canvas.size
+
+
+def get_text_slice(text, start, count):
+    """Returns count characters of the text starting at start, wrapping around to the beginning of the text."""
+    if count <= 0:
+        return ''
+    start %= len(text)
+    pieces = []
+    while count > 0:
+        piece = text[start:start + count]
+        pieces.append(piece)
+        count -= len(piece)
+        start = 0
+    return ''.join(pieces)
+
+
+class TextCanvas:
+    """
+        The text canvas of a scaled image.  Any horizontal strip of the canvas can be painted on its own and is
+        identical to the same rows of the fully painted canvas, which allows the canvas to be painted in parallel
+        bands.
+    """
+
+    def __init__(self, text, image, font, margin, threshold, background_color, renderer='atlas', atlas=None,
+                 glyph_cache=None):
+        """Initialize the TextCanvas.  The arguments are the same as the arguments of get_text_image."""
+        if renderer not in RENDERERS:
+            raise ValueError('unknown renderer [%s], expected one of %s' % (renderer, RENDERERS))
+
+        self.pixels = get_pixel_array(image)
+        self.font = font
+        self.margin = margin
+        self.threshold = threshold
+        self.background_color = (background_color[0], background_color[1], background_color[2], 255)
+        self.renderer = renderer
+
+        height, width = self.pixels.shape[:2]
+        self.size = (width * font[1] + margin[0] * 2, math.ceil(height * font[2]) + margin[1] * 2)
+
+        # the text offset of the first painted character of every row
+        painted_per_row = np.count_nonzero(should_paint_pixels(self.pixels, threshold), axis=1)
+        self.row_offsets = np.concatenate(([0], np.cumsum(painted_per_row)))
+        self.text = text
+
+        # every glyph is rasterized up front so the footprint is known before any rows are painted
+        characters = text.get_characters() if isinstance(text, TextSource) else text
+        if atlas is None:
+            atlas = GlyphAtlas(font[0], characters, glyph_cache)
+        else:
+            atlas.add(characters)
+        self.atlas = atlas
+
+    def get_painted_count(self):
+        """Returns the number of characters painted on the canvas."""
+        return int(self.row_offsets[-1])
+
+    def get_row_range(self, top, bottom):
+        """Returns the (first, last) image rows, last exclusive, whose characters touch the canvas rows top to bottom."""
+        footprint_top, _, footprint_bottom, _ = self.atlas.footprint
+        row_count = self.pixels.shape[0]
+        first = math.floor((top - self.margin[1] - footprint_bottom) / self.font[2]) + 1
+        last = math.ceil((bottom - self.margin[1] - footprint_top) / self.font[2])
+        return min(max(first, 0), row_count), min(max(last, 0), row_count)
+
+    def render_rows(self, top, bottom):
+        """
+        Paints the canvas rows from top to bottom, bottom exclusive.
+
+        Returns:
+            A (bottom - top)xWx4 uint8 array containing the painted rows.
+        """
+        first, last = self.get_row_range(top, bottom)
+        start = int(self.row_offsets[first])
+        text = get_text_slice(self.text, start, int(self.row_offsets[last]) - start)
+        origin = (self.margin[0], self.margin[1] + first * self.font[2] - top)
+        if self.renderer == 'reference' and last > first:
+            canvas = Image.new('RGBA', (self.size[0], bottom - top), self.background_color)
+            _paint_reference(canvas, text, self.pixels[first:last], self.font, origin, self.threshold)
+            return np.asarray(canvas)
+
+        canvas = np.empty((bottom - top, self.size[0], 4), dtype=np.uint8)
+        canvas[...] = self.background_color
+        if last > first:
+            _paint_atlas(canvas, text, self.pixels[first:last], self.font, origin, self.threshold, self.atlas)
+        return canvas
+
+
+def _paint_reference(final_image, text, pixels, font, margin, threshold):
+    """Paints the text by calling ImageDraw.text for every painted pixel of an HxWx4 array."""
+    text_size = len(text)
+    d = ImageDraw.Draw(final_image)
+    y = margin[1]
+    text_count = 0
+
+    for row in iter_pixel_rows(pixels):
+        x = margin[0]
+        for pixel in row:
+            if should_paint_pixel(pixel, threshold):
+                d.text((x, y), text[text_count %
+                       text_size], font=font[0], fill=pixel)
+                text_count += 1
+            x += font[1]
+        y += font[2]
+
+
+def _paint_atlas(canvas, text, pixels, font, margin, threshold, atlas):
+    """Paints the text by blending the pre-rasterized glyph masks of the atlas in bulk."""
+    rows, columns = np.nonzero(should_paint_pixels(pixels, threshold))
+    glyphs = atlas.get_glyph_indices(text[:len(rows)])
+    atlas.paint(canvas, (rows, columns), glyphs, pixels[rows, columns], margin, (font[1], font[2]))
@@ -0,0 +1,83 @@
+import logging
+
+ENCODERS = ['png', 'webp', 'jpeg', 'raw']
+# the encoder picked for an output file extension, other extensions are saved with Pillow's defaults
+EXTENSIONS = {'.png': 'png', '.webp': 'webp', '.jpg': 'jpeg', '.jpeg': 'jpeg', '.rgba': 'raw', '.raw': 'raw'}
+# Pillow's default zlib level, 0 stores the pixels uncompressed and 9 is the smallest and slowest
+DEFAULT_COMPRESS_LEVEL = 6
+
+
+def get_encoder(filename):
+    """Returns the encoder matching the extension of the filename or None for other files."""
+    for extension, encoder in EXTENSIONS.items():
+        if filename.lower().endswith(extension):
+            return encoder
+    return None
+
+
+def get_extension(encoder):
+    """Returns the file extension of the encoder's files."""
+    for extension, extension_encoder in EXTENSIONS.items():
+        if extension_encoder == encoder:
+            return extension
+    raise ValueError('unknown encoder [%s], expected one of %s' % (encoder, ENCODERS))
+
+
+def get_save_options(encoder, compress_level=DEFAULT_COMPRESS_LEVEL, quality=None):
+    """
+    Returns the Pillow save arguments of an encoder.
+
+    Args:
+        encoder: 'png', 'webp' or 'jpeg'.
+        compress_level: The PNG zlib compression level between 0 (fastest) and 9 (smallest).
+        quality: The WebP or JPEG quality between 0 and 100, lower is smaller and faster.  WebP at 100 is lossless.
+            default: Pillow's default quality
+
+    Returns:
+        A dict of keyword arguments for Image.save.
+    """
+    if encoder == 'png':
+        return {'format': 'PNG', 'compress_level': compress_level}
+    if encoder == 'webp':
+        options = {'format': 'WEBP'}
+        if quality is not None:
+            options.update(quality=quality, lossless=quality >= 100)
+        return options
+    if encoder == 'jpeg':
+        return {'format': 'JPEG'} if quality is None else {'format': 'JPEG', 'quality': quality}
+    raise ValueError('unknown encoder [%s], expected one of %s' % (encoder, ENCODERS))
+
+
+def save_image(image, file, encoder=None, compress_level=DEFAULT_COMPRESS_LEVEL, quality=None):
+    """
+    Saves the image with the given encoder settings.
+
+    Args:
+        image: The image to save.
+        file: A filename or a binary file object.
+        encoder: 'png', 'webp', 'jpeg' or 'raw', which writes the RGBA pixels row by row without a header or
+            compression.  default: picked from the extension of the filename, other files are saved by Pillow with
+            its default settings
+        compress_level: The PNG zlib compression level between 0 (fastest) and 9 (smallest). default: 6
+        quality: The WebP or JPEG quality between 0 and 100. default: Pillow's default quality
+    """
+    if encoder is None and isinstance(file, str):
+        encoder = get_encoder(file)
+    if encoder is None:
+        image.save(file)
+        return
+
+    logging.debug('encoding [%s] image of size [%s]', encoder, image.size)
+    if encoder == 'raw':
+        pixels = image.tobytes() if image.mode == 'RGBA' else image.convert('RGBA').tobytes()
+        if isinstance(file, str):
+            with open(file, 'wb') as raw_file:
+                raw_file.write(pixels)
+        else:
+            file.write(pixels)
+        return
+
+    if encoder == 'jpeg' and image.mode != 'RGB':
+        # JPEG has no alpha channel
+        image = image.convert('RGB')
+    image.save(file, **get_save_options(encoder, compress_level, quality))
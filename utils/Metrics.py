@@ -0,0 +1,158 @@
+import functools
+import json
+import logging
+import threading
+import time
+
+# the most individual span events kept for the report, aggregates are always complete
+MAX_EVENTS = 10000
+
+_enabled = False
+_lock = threading.Lock()
+_hooks = []
+_start = time.perf_counter()
+_spans = {}
+_counters = {}
+_events = []
+
+
+class _Span:
+    """Times the block it wraps and records it when metrics are enabled."""
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter()
+        _record_span(self.name, self.start, end - self.start)
+        return False
+
+
+class _NullSpan:
+    """The span returned while metrics are disabled, it does nothing."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def enable():
+    """Starts recording spans and counters."""
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """Stops recording, spans and counters become no-ops again.  Recorded values are kept until reset is called."""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """Removes every recorded span, counter and event."""
+    global _start
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+        _events.clear()
+        _start = time.perf_counter()
+
+
+def span(name):
+    """
+    Returns a context manager timing the block it wraps under the given name.
+
+    Example:
+        with Metrics.span('scaler.resize'):
+            image = image.resize(size)
+    """
+    return _Span(name) if _enabled else _NULL_SPAN
+
+
+def timed(name):
+    """Decorator recording every call of the function as a span with the given name."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    """Adds value to the counter with the given name."""
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+    for hook in _hooks:
+        hook('counter', name, value)
+
+
+def add_hook(hook):
+    """
+    Registers a function called with (kind, name, value) for every recorded metric, where kind is 'span' and value
+    the duration in seconds or kind is 'counter' and value the amount added.  Hooks are only called while metrics
+    are enabled and are called on the thread that recorded the metric.
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def get_report():
+    """
+    Returns a dict with the count, total, and maximum seconds of every span name, the value of every counter and the
+    first MAX_EVENTS individual spans in the order they finished.
+    """
+    with _lock:
+        return {
+            'spans': {name: {'count': total[0], 'seconds': total[1], 'max_seconds': total[2]}
+                      for name, total in _spans.items()},
+            'counters': dict(_counters),
+            'events': list(_events),
+        }
+
+
+def write_report(filename):
+    """Writes the report to a JSON file."""
+    with open(filename, mode='wt', encoding='UTF-8') as file:
+        json.dump(get_report(), file, indent=2)
+    logging.info('writing profile to [%s]', filename)
+
+
+def _record_span(name, start, seconds):
+    with _lock:
+        total = _spans.get(name)
+        if total is None:
+            _spans[name] = [1, seconds, seconds]
+        else:
+            total[0] += 1
+            total[1] += seconds
+            total[2] = max(total[2], seconds)
+        if len(_events) < MAX_EVENTS:
+            _events.append({'name': name, 'start': start - _start, 'seconds': seconds})
+    for hook in _hooks:
+        hook('span', name, seconds)
@@ -0,0 +1,120 @@
+import logging
+import queue
+import threading
+
+import utils.Metrics as Metrics
+
+# the number of items waiting between two stages, bounds the decoded and painted images held in memory
+DEFAULT_QUEUE_SIZE = 2
+# how often a blocked stage checks whether the pipeline was stopped, in seconds
+POLL_INTERVAL = 0.1
+
+_DONE = object()
+
+
+class Pipeline:
+    """
+        Runs a sequence of stages on a stream of items with every stage on its own thread, so while one item is being
+        painted the next one can already be decoded and the previous one encoded.  Stages are connected by bounded
+        queues, a stage that gets ahead blocks until the next stage catches up.  Items leave the pipeline in the order
+        they entered it.  Most of the work of decoding, painting and zlib compression happens outside the GIL, so the
+        stages really run at the same time.
+    """
+
+    def __init__(self, stages, queue_size=DEFAULT_QUEUE_SIZE):
+        """Initialize the Pipeline.
+
+        Args:
+            stages: A list of (name, function) tuples.  Every function takes the value returned by the previous stage,
+                the first one takes the item.
+            queue_size: The most values waiting between two stages.
+        """
+        if not stages:
+            raise ValueError('a pipeline needs at least one stage')
+        if queue_size < 1:
+            raise ValueError('queue_size must be at least 1, got [%s]' % queue_size)
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def run(self, items):
+        """
+        Yields the value returned by the last stage for every item.  If a stage raises, the pipeline is stopped and
+        the exception is raised here.  Stages that should survive a failed item have to catch the exception
+        themselves and pass on a value describing the failure.
+        """
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        stop = threading.Event()
+        errors = []
+
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0], stop, errors), daemon=True,
+                                    name='pipeline-feed')]
+        for i, (name, function) in enumerate(self.stages):
+            threads.append(threading.Thread(target=self._run_stage,
+                                            args=(name, function, queues[i], queues[i + 1], stop, errors),
+                                            daemon=True, name='pipeline-' + name))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                value = _get(queues[-1], stop)
+                if value is _DONE:
+                    break
+                yield value
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+
+    @staticmethod
+    def _feed(items, output, stop, errors):
+        try:
+            for item in items:
+                if not _put(output, item, stop):
+                    return
+        except Exception as ex:
+            errors.append(ex)
+            stop.set()
+            return
+        _put(output, _DONE, stop)
+
+    @staticmethod
+    def _run_stage(name, function, source, output, stop, errors):
+        while True:
+            value = _get(source, stop)
+            if value is _DONE:
+                _put(output, _DONE, stop)
+                return
+            try:
+                with Metrics.span('pipeline.' + name):
+                    value = function(value)
+            except Exception as ex:
+                logging.debug('pipeline stage [%s] failed: %s', name, ex)
+                errors.append(ex)
+                stop.set()
+                return
+            if not _put(output, value, stop):
+                return
+
+
+def _put(output, value, stop):
+    """Puts the value in the queue, returning False instead if the pipeline is stopped while waiting."""
+    while not stop.is_set():
+        try:
+            output.put(value, timeout=POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(source, stop):
+    """Returns the next value of the queue or _DONE if the pipeline is stopped while waiting."""
+    while not stop.is_set():
+        try:
+            return source.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            pass
+    return _DONE
@@ -1,14 +1,185 @@
 import logging
 import math
 
+import numpy as np
+
+# the weighted square of every 8 bit channel value, brightness is the square root of the sum of a pixel's three values
+RED_SQUARES = [.241 * math.pow(value, 2) for value in range(256)]
+GREEN_SQUARES = [.691 * math.pow(value, 2) for value in range(256)]
+BLUE_SQUARES = [.068 * math.pow(value, 2) for value in range(256)]
+_RED_TABLE = np.array(RED_SQUARES, dtype=np.float64)
+_GREEN_TABLE = np.array(GREEN_SQUARES, dtype=np.float64)
+_BLUE_TABLE = np.array(BLUE_SQUARES, dtype=np.float64)
+
+# the number of thresholds whose squared bounds and blue limit tables are kept, each table is 128KB
+MAX_CACHED_THRESHOLDS = 64
+# the most pixels turned into Python tuples at once when pixels have to be iterated one by one
+ITER_CHUNK_PIXELS = 1 << 12
+
+_squared_thresholds = {}
+_blue_limits = {}
+
+
 def get_pixels(image):
-    return list(image.getdata())
+    """Returns a list with the value of every pixel.  Prefer iter_pixels, which doesn't hold a tuple for every pixel."""
+    return list(iter_pixels(image))
+
+
+def get_pixel_view(image):
+    """
+    Returns a read-only HxWxC array of the pixels of the image in its own mode, HxW for single band images.  Pillow
+    copies the pixels out as a single buffer, no Python object is created per pixel.
+    """
+    pixels = np.asarray(image.convert('L') if image.mode == '1' else image)
+    if pixels.flags.writeable:
+        pixels = pixels.view()
+        pixels.flags.writeable = False
+    return pixels
+
+
+def iter_pixel_rows(pixels):
+    """
+    Yields a list with the value of every pixel of each row of an image or pixel array, a tuple for multi band pixels
+    like Image.getdata returns.  The rows are converted to Python objects ITER_CHUNK_PIXELS pixels at a time, so only
+    a bounded number of per pixel objects exists at once.  Images are copied out a strip of rows at a time as well.
+    """
+    is_image = not isinstance(pixels, np.ndarray)
+    width, height = pixels.size if is_image else (pixels.shape[1], pixels.shape[0])
+    rows_per_chunk = max(1, ITER_CHUNK_PIXELS // max(width, 1))
+    for top in range(0, height, rows_per_chunk):
+        bottom = min(top + rows_per_chunk, height)
+        chunk = get_pixel_view(pixels.crop((0, top, width, bottom))) if is_image else pixels[top:bottom]
+        for row in chunk.tolist():
+            yield [tuple(pixel) for pixel in row] if chunk.ndim == 3 else row
+
+
+def iter_pixels(pixels):
+    """Yields the value of every pixel of an image or pixel array in row order, see iter_pixel_rows."""
+    for row in iter_pixel_rows(pixels):
+        yield from row
 
 
 def should_paint_pixel(pixel, max_threshold_brightness):
-    return get_pixel_brightness(pixel) < max_threshold_brightness
+    r, g, b = pixel[0], pixel[1], pixel[2]
+    try:
+        # negative values would silently read the tables from their end, values above 255 raise IndexError
+        if r < 0 or g < 0 or b < 0:
+            raise IndexError
+        squared_brightness = RED_SQUARES[r] + GREEN_SQUARES[g] + BLUE_SQUARES[b]
+    except (TypeError, IndexError):
+        return get_pixel_brightness(pixel) < max_threshold_brightness
+    return squared_brightness < get_squared_threshold(max_threshold_brightness)
 
 
 def get_pixel_brightness(pixel):
-    r, g, b, x = pixel
-    return math.sqrt(.241 * math.pow(r, 2) + .691 * math.pow(g, 2) + .068 * math.pow(b, 2))
\ No newline at end of file
+    r, g, b = pixel[0], pixel[1], pixel[2]
+    if type(r) is int and type(g) is int and type(b) is int and 0 <= r < 256 and 0 <= g < 256 and 0 <= b < 256:
+        return math.sqrt(RED_SQUARES[r] + GREEN_SQUARES[g] + BLUE_SQUARES[b])
+    return math.sqrt(.241 * math.pow(r, 2) + .691 * math.pow(g, 2) + .068 * math.pow(b, 2))
+
+
+def get_squared_threshold(max_threshold_brightness):
+    """
+    Returns the smallest sum of weighted squares whose square root is not below the threshold.  A pixel is below the
+    threshold exactly when its sum of weighted squares is below this value, so no square root is needed.  Squaring the
+    threshold isn't enough on its own since both the square and the square root round.
+    """
+    bound = _squared_thresholds.get(max_threshold_brightness)
+    if bound is None:
+        threshold = float(max_threshold_brightness)
+        if not threshold > 0:
+            # nothing is below a threshold of 0 or less, or NaN
+            bound = 0.0
+        else:
+            bound = threshold * threshold
+            while math.sqrt(bound) >= threshold:
+                bound = math.nextafter(bound, -math.inf)
+            while math.sqrt(bound) < threshold:
+                bound = math.nextafter(bound, math.inf)
+        if len(_squared_thresholds) >= MAX_CACHED_THRESHOLDS:
+            _squared_thresholds.clear()
+        _squared_thresholds[max_threshold_brightness] = bound
+    return bound
+
+
+def should_paint_pixels(pixels, max_threshold_brightness):
+    """
+    Returns a boolean array that is true for every pixel of an HxWx4 array that should_paint_pixel would paint.
+
+    Every red and green pair has a limit the blue channel has to stay below for the pixel to be painted, so the mask
+    is a single lookup of that limit and a comparison.
+    """
+    limits = _get_blue_limits(get_squared_threshold(max_threshold_brightness))
+    return pixels[..., 2] < limits[_get_red_green_indices(pixels)]
+
+
+def get_pixels_brightness(pixels):
+    """Returns the brightness of every pixel of an HxWx4 array, computed exactly as get_pixel_brightness does."""
+    return np.sqrt(get_pixels_squared_brightness(pixels))
+
+
+def get_pixels_squared_brightness(pixels):
+    """Returns the sum of weighted squares of every pixel of an HxWx4 array, the square of its brightness."""
+    squares = _RED_TABLE[pixels[..., 0]]
+    squares += _GREEN_TABLE[pixels[..., 1]]
+    squares += _BLUE_TABLE[pixels[..., 2]]
+    return squares
+
+
+def apply_lookup_table(pixels, table):
+    """
+    Returns a copy of an HxWx4 uint8 array where every value of channel c is replaced by table[c][value].  The red
+    and green and the blue and alpha channels are looked up in pairs through two 64K tables, halving the lookups.
+    """
+    processed = np.empty_like(pixels)
+    if np.little_endian and pixels.dtype == np.uint8 and pixels.flags.c_contiguous:
+        values = np.arange(65536)
+        pairs = processed.view(np.uint16)
+        for pair, (low, high) in enumerate(((0, 1), (2, 3))):
+            pair_table = table[low][values & 255].astype(np.uint16) | (table[high][values >> 8].astype(np.uint16) << 8)
+            np.take(pair_table, pixels.view(np.uint16)[..., pair], out=pairs[..., pair], mode='clip')
+        return processed
+
+    for channel in range(4):
+        np.take(table[channel], pixels[..., channel], out=processed[..., channel], mode='clip')
+    return processed
+
+
+def get_pixel_array(image):
+    """Returns the pixels of the image as a read-only HxWx4 uint8 RGBA array, see get_pixel_view."""
+    return get_pixel_view(image if image.mode == 'RGBA' else image.convert('RGBA'))
+
+
+def _get_blue_limits(bound):
+    """
+    Returns a table indexed by red + 256 * green containing the number of blue values a pixel with that red and green
+    can have while its sum of weighted squares stays below bound.  The sums are computed in the same order as
+    get_pixel_brightness, so the table gives the same decisions.
+    """
+    limits = _blue_limits.get(bound)
+    if limits is None:
+        red_green = (_RED_TABLE[None, :] + _GREEN_TABLE[:, None]).reshape(-1)
+        # searchsorted is off by at most one where bound - red_green rounds differently than the sum
+        limits = np.searchsorted(_BLUE_TABLE, bound - red_green)
+        while True:
+            too_high = (limits > 0) & (red_green + _BLUE_TABLE[np.maximum(limits - 1, 0)] >= bound)
+            too_low = (limits < 256) & (red_green + _BLUE_TABLE[np.minimum(limits, 255)] < bound)
+            if not too_high.any() and not too_low.any():
+                break
+            limits = limits - too_high + too_low
+        limits = limits.astype(np.uint16)
+        logging.debug('computed blue limits for squared threshold [%s]', bound)
+        if len(_blue_limits) >= MAX_CACHED_THRESHOLDS:
+            _blue_limits.clear()
+        _blue_limits[bound] = limits
+    return limits
+
+
+def _get_red_green_indices(pixels):
+    """Returns red + 256 * green of every pixel of an HxWx4 uint8 array."""
+    if np.little_endian and pixels.dtype == np.uint8:
+        try:
+            return pixels.view(np.uint16)[..., 0]
+        except ValueError:
+            pass
+    return pixels[..., 0].astype(np.uint16) | (pixels[..., 1].astype(np.uint16) << 8)
@@ -0,0 +1,170 @@
+import codecs
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+
+import numpy as np
+
+# a code point byte offset is stored for every INDEX_INTERVAL characters of a non-ascii text
+INDEX_INTERVAL = 4096
+# the number of bytes read at once while normalizing and indexing a text
+CHUNK_SIZE = 1 << 22
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'textify-image', 'text')
+
+
+class TextSource:
+    """
+        A UTF-8 text file that behaves like the string TextProcessor.get_text would return without ever loading the
+        whole text into memory.  The file is memory-mapped, newlines are replaced by spaces and characters are decoded
+        only when they are accessed, so len(), indexing and slicing cost the same for a small book or a multi-GB corpus.
+
+        Files containing carriage returns are normalized once into a copy in the cache directory.  Non-ascii files
+        also get a code point offset index which is saved next to it so reopening the same file is instant.
+    """
+
+    def __init__(self, filename, cache_dir=None):
+        """Initialize the TextSource.
+
+        Args:
+            filename: The path of a UTF-8 text file.
+            cache_dir: The directory used for normalized copies and indexes. default: a directory in the system temp dir
+
+        Raises:
+            UnicodeDecodeError: The file isn't valid UTF-8.
+        """
+        self.filename = filename
+        self.cache_dir = DEFAULT_CACHE_DIR if cache_dir is None else cache_dir
+        self._open()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            if step != 1:
+                return ''.join(self[i] for i in range(start, stop, step))
+            if stop <= start:
+                return ''
+            return self._decode(self._get_byte_offset(start), self._get_byte_offset(stop))
+
+        index = key + self.length if key < 0 else key
+        if index < 0 or index >= self.length:
+            raise IndexError('text index out of range')
+        return self[index:index + 1]
+
+    def __iter__(self):
+        for start in range(0, self.length, CHUNK_SIZE):
+            yield from self[start:start + CHUNK_SIZE]
+
+    def __getstate__(self):
+        return {'filename': self.filename, 'cache_dir': self.cache_dir}
+
+    def __setstate__(self, state):
+        self.filename = state['filename']
+        self.cache_dir = state['cache_dir']
+        self._open()
+
+    def get_characters(self):
+        """Returns the set of distinct characters of the text."""
+        return set(self.characters)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _open(self):
+        stat = os.stat(self.filename)
+        key = hashlib.sha1(('%s:%s:%s' % (os.path.abspath(self.filename), stat.st_size, stat.st_mtime_ns))
+                           .encode('UTF-8')).hexdigest()
+        path = self.filename
+        self._map = self._map_file(path)
+        if self._map is not None and self._map.find(b'\r') != -1:
+            path = os.path.join(self.cache_dir, key + '.txt')
+            if not os.path.exists(path):
+                self._write_normalized_copy(path)
+            self._map.close()
+            self._map = self._map_file(path)
+        self.size = len(self._map) if self._map is not None else 0
+
+        index_path = os.path.join(self.cache_dir, key + '.npz')
+        if os.path.exists(index_path):
+            with np.load(index_path) as index:
+                self.length, self.offsets, self.characters = int(index['length']), index['offsets'], str(index['characters'])
+        else:
+            self._build_index()
+            if self.size:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                temporary_path = '%s.%s.tmp' % (index_path, os.getpid())
+                with open(temporary_path, 'wb') as file:
+                    np.savez(file, length=self.length, offsets=self.offsets, characters=self.characters)
+                os.replace(temporary_path, index_path)
+        logging.debug('text source [%s] - characters: [%s] bytes: [%s]', self.filename, self.length, self.size)
+
+    @staticmethod
+    def _map_file(path):
+        if os.path.getsize(path) == 0:
+            return None
+        with open(path, 'rb') as file:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _write_normalized_copy(self, path):
+        """Writes a copy of the file where every \\r\\n and lone \\r is replaced by \\n, like a universal newline read."""
+        logging.info('normalizing newlines of [%s]', self.filename)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temporary_path = '%s.%s.tmp' % (path, os.getpid())
+        pending_return = False
+        with open(temporary_path, 'wb') as file:
+            for start in range(0, len(self._map), CHUNK_SIZE):
+                chunk = self._map[start:start + CHUNK_SIZE]
+                if pending_return and chunk.startswith(b'\n'):
+                    chunk = chunk[1:]
+                pending_return = chunk.endswith(b'\r')
+                file.write(chunk.replace(b'\r\n', b'\n').replace(b'\r', b'\n'))
+        os.replace(temporary_path, path)
+
+    def _build_index(self):
+        """Counts the characters, validates the encoding and records the byte offset of every INDEX_INTERVAL character."""
+        decoder = codecs.getincrementaldecoder('UTF-8')()
+        characters = set()
+        offsets = []
+        length = 0
+        for start in range(0, self.size, CHUNK_SIZE):
+            chunk = np.frombuffer(self._map, dtype=np.uint8, count=min(CHUNK_SIZE, self.size - start), offset=start)
+            if not (chunk & 0x80).any():
+                offsets.append(np.arange(-length % INDEX_INTERVAL, len(chunk), INDEX_INTERVAL) + start)
+                characters.update(chr(c) for c in np.flatnonzero(np.bincount(chunk, minlength=128)))
+                length += len(chunk)
+                continue
+
+            characters.update(decoder.decode(chunk.tobytes()))
+            leads = np.flatnonzero((chunk & 0xC0) != 0x80)
+            offsets.append(leads[-length % INDEX_INTERVAL::INDEX_INTERVAL] + start)
+            length += len(leads)
+        decoder.decode(b'', final=True)
+
+        if '\n' in characters:
+            characters.discard('\n')
+            characters.add(' ')
+        self.length = length
+        self.offsets = np.concatenate(offsets).astype(np.int64) if offsets else np.zeros(0, dtype=np.int64)
+        self.characters = ''.join(sorted(characters))
+
+    def _get_byte_offset(self, index):
+        """Returns the byte offset of the character at index."""
+        if index >= self.length:
+            return self.size
+        if self.length == self.size:
+            return index
+        block, rest = divmod(index, INDEX_INTERVAL)
+        start = int(self.offsets[block])
+        if rest == 0:
+            return start
+        window = np.frombuffer(self._map, dtype=np.uint8, count=min(4 * INDEX_INTERVAL, self.size - start), offset=start)
+        return start + int(np.flatnonzero((window & 0xC0) != 0x80)[rest])
+
+    def _decode(self, start, stop):
+        return self._map[start:stop].decode('UTF-8').replace('\n', ' ')